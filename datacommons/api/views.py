@@ -3,15 +3,13 @@ import decimal
 import os
 import re
 import json
-import shapefile
-import zipfile
-import tempfile
+import cStringIO
 from datacommons.jsonencoder import JSONEncoder
 from datacommons.unicodecsv import UnicodeWriter
 from django.conf import settings as SETTINGS
 from django.contrib.gis.geos import GEOSGeometry
 from django.template.loader import render_to_string
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.core.urlresolvers import reverse
 from django.db import DatabaseError, transaction, DatabaseError, connection, connections
@@ -19,9 +17,19 @@ from django.core.exceptions import PermissionDenied
 from datacommons.utils.dbhelpers import fetchRowsFor
 from datacommons.schemas.models import Version, ColumnTypes, Table
 from .models import DownloadLog
+from .writers import ShapefileWriter, ZipStream
+
+# the most rows that can be fetched in a page of JSON
+MAX_PAGE_SIZE = 10000
+
+# the number of rows encoded at a time when streaming an export
+STREAM_CHUNK_ROWS = 500
 
 def view(request, schema, table, format):
-    """View the table in schema, including the column names and types"""
+    """View the table in schema, including the column names and types. The
+    JSON can be fetched a page at a time by passing `limit`, and then the
+    `after` or `before` cursor from the previous page. Otherwise, CSV, JSON
+    and NDJSON (one JSON object per line) are streamed as the rows are read"""
     # get all the data
     version_id = request.GET.get("version_id")
     if version_id:
@@ -32,18 +40,40 @@ def view(request, schema, table, format):
 
 
     response = HttpResponse()
+    paged = format == "json" and any(param in request.GET for param in ["limit", "after", "before"])
+    if paged:
+        try:
+            limit = max(1, min(int(request.GET.get("limit", 1000)), MAX_PAGE_SIZE))
+            rows = pageable.keysetPage(limit, after=request.GET.get("after"), before=request.GET.get("before"))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+    else:
+        rows = pageable
+
     cols = pageable.cols
     if format == "csv":
-        response['Content-Type'] = 'text/csv'
-        writer = UnicodeWriter(response)
-        writer.writerow([col.name for col in cols])
-        for row in pageable:
-            writer.writerow([unicode(c) for c in row])
+        # PostgreSQL can write the CSV itself, which is a lot faster, unless
+        # the columns can't be told apart by name
+        try:
+            chunks = pageable.copyCSV()
+        except ValueError:
+            chunks = _csvChunks(cols, pageable)
+        response = StreamingHttpResponse(chunks, content_type="text/csv")
+    elif format == "json" and not paged:
+        response = StreamingHttpResponse(_jsonChunks(cols, pageable), content_type="application/json")
+    elif format == "ndjson":
+        response = StreamingHttpResponse(_ndjsonChunks(cols, pageable), content_type="application/x-ndjson")
     elif format == "json":
         response['Content-Type'] = 'application/json'
         data = []
-        for row in pageable:
+        for row in rows:
             data.append(dict([(col.name, cell) for col, cell in zip(cols, row)]))
+        if paged:
+            data = {
+                "results": data,
+                "next": rows.next_cursor if rows.has_next else None,
+                "previous": rows.previous_cursor if rows.has_previous else None,
+            }
         json.dump(data, response, cls=JSONEncoder)
     elif format == "kml":
         response['Content-Type'] = 'application/vnd.google-earth.kml+xml'
@@ -59,40 +89,18 @@ def view(request, schema, table, format):
             "table": table
         }))
     elif format == "zip":
-        response['Content-Type'] = 'application/octet-stream'
-        # for each non geom column figure out which field to create on the shapefile
-        # write all the field values and shape
-
-        for i, row in enumerate(pageable):
-            # do all the initialization
-            if i == 0:
-                cols = pageable.cols
-                writer, geom_col_index = _getShapefileWriter(cols, row)
-
-            record = [str(item) for item, col in zip(row, cols) if col.type != ColumnTypes.GEOMETRY]
-            writer.record(*record)
-            if writer.shapeType == shapefile.POINT:
-                writer.point(*(row[geom_col_index].coords))
-            else:
-                writer.poly(row[geom_col_index].coords)
-
-        shp = tempfile.TemporaryFile()
-        dbf = tempfile.TemporaryFile()
-        shx = tempfile.TemporaryFile()
-        writer.save(shp=shp, dbf=dbf, shx=shx)
-        zip_ = tempfile.TemporaryFile()
-        z = zipfile.ZipFile(zip_, 'w')
-
-        shp.seek(0)
-        z.writestr('%s.shp' % table, shp.read())
-        dbf.seek(0)
-        z.writestr('%s.dbf' % table, dbf.read())
-        shx.seek(0)
-        z.writestr('%s.shx' % table, shx.read())
-        z.writestr('%s.prj' % table, SETTINGS.OFFICIAL_PRJ)
-        z.close()
-        zip_.seek(0)
-        response.write(zip_.read())
+        # the shapefile is written to temporary files as the rows are read, and
+        # then zipped up as the response is sent
+        try:
+            shp, shx, dbf = _writeShapefile(cols, pageable)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+        response = StreamingHttpResponse(ZipStream([
+            ('%s.shp' % table, shp),
+            ('%s.dbf' % table, dbf),
+            ('%s.shx' % table, shx),
+            ('%s.prj' % table, cStringIO.StringIO(SETTINGS.OFFICIAL_PRJ)),
+        ]), content_type='application/octet-stream')
 
     DownloadLog(
         file_extension=format, 
@@ -103,34 +111,56 @@ def view(request, schema, table, format):
 
     return response 
 
-def _getShapefileWriter(cols, row):
-    geom_type_to_shapefile_type = {
-        'Point': shapefile.POINT,
-        'LineString': shapefile.POLYLINE,
-        'Polygon': shapefile.POLYGON,
-        'MultiPoint': shapefile.MULTIPOINT,
-        'MultiLineString': shapefile.POLYLINE,
-        'MultiPolygon': shapefile.POLYGON,
-        None: shapefile.NULL,
-    }
-    geom_type = None
-    # figure out the geom type of the geometry column
-    for geom_col_index, col in enumerate(cols):
-        # find the index of the first geom column
-        if col.type == ColumnTypes.GEOMETRY:
-            break
-
-    # get the geom_type of that GEOSGeometry object in the row
-    geom_type = row[geom_col_index].geom_type
+def _csvChunks(cols, rows):
+    """Yield the CSV of the rows, STREAM_CHUNK_ROWS rows at a time"""
+    buffer = cStringIO.StringIO()
+    writer = UnicodeWriter(buffer)
+    writer.writerow([col.name for col in cols])
+    for i, row in enumerate(rows, 1):
+        writer.writerow([unicode(c) for c in row])
+        if i % STREAM_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
-    # find the geom type
-    w = shapefile.Writer(geom_type_to_shapefile_type[geom_type])
+def _jsonChunks(cols, rows):
+    """Yield a JSON list of an object for each row, STREAM_CHUNK_ROWS rows
+    at a time"""
+    encoder = JSONEncoder()
+    chunk = ["["]
+    for i, row in enumerate(rows, 1):
+        if i > 1:
+            chunk.append(",")
+        chunk.append(encoder.encode(dict([(col.name, cell) for col, cell in zip(cols, row)])))
+        if i % STREAM_CHUNK_ROWS == 0:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]")
+    yield "".join(chunk)
 
-    # now add all the columns to the shapefile besides the geom ones
-    for col in cols:
-        if col.type == ColumnTypes.GEOMETRY:
-            continue
-        w.field(name=col.name[:10])
+def _ndjsonChunks(cols, rows):
+    """Yield a line of JSON for each row, STREAM_CHUNK_ROWS rows at a
+    time"""
+    encoder = JSONEncoder()
+    chunk = []
+    for i, row in enumerate(rows, 1):
+        chunk.append(encoder.encode(dict([(col.name, cell) for col, cell in zip(cols, row)])) + "\n")
+        if i % STREAM_CHUNK_ROWS == 0:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk)
 
-    return w, geom_col_index
+def _writeShapefile(cols, pageable):
+    """Write the rows into a shapefile one at a time, and return its .shp, .shx
+    and .dbf files. The first geometry column is the shape, and the rest of
+    the columns (besides geometries) are the fields"""
+    geom_col_index = next((i for i, col in enumerate(cols) if col.type == ColumnTypes.GEOMETRY), None)
+    if geom_col_index is None:
+        raise ValueError("There is no geometry column")
 
+    field_indexes = [i for i, col in enumerate(cols) if col.type != ColumnTypes.GEOMETRY]
+    writer = ShapefileWriter([cols[i].name for i in field_indexes])
+    for row in pageable.wkbRows():
+        writer.write([row[i] for i in field_indexes], row[geom_col_index])
+    return writer.close()
@@ -0,0 +1,333 @@
+"""
+Writers for exports that are too big to build in memory.
+
+ShapefileWriter writes a shapefile a record at a time into temporary files,
+straight from WKB, and fills in the headers (which need the number of records,
+the bounding box and so on) when it is done. ZipStream then zips up the files
+as the response is sent.
+"""
+import sys
+import zlib
+import time
+import array
+import struct
+import tempfile
+
+# shapefile shape types
+NULL = 0
+POINT = 1
+POLYLINE = 3
+POLYGON = 5
+MULTIPOINT = 8
+
+# WKB geometry types
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+WKB_MULTIPOINT = 4
+WKB_MULTILINESTRING = 5
+WKB_MULTIPOLYGON = 6
+
+# the shapefile shape type for each WKB type
+WKB_TO_SHAPE_TYPE = {
+    WKB_POINT: POINT,
+    WKB_LINESTRING: POLYLINE,
+    WKB_POLYGON: POLYGON,
+    WKB_MULTIPOINT: MULTIPOINT,
+    WKB_MULTILINESTRING: POLYLINE,
+    WKB_MULTIPOLYGON: POLYGON,
+}
+
+# the size of every field in the .dbf. The fields are all text
+FIELD_SIZE = 50
+
+class ShapefileWriter(object):
+    """
+    This writes a shapefile into temporary .shp, .shx and .dbf files one
+    record at a time, so only one record is ever in memory. The shape type is
+    taken from the first geometry that isn't null. Every field is text.
+
+    writer = ShapefileWriter(["name", "population"])
+    writer.write([u"Portland", 583776], wkb)
+    shp, shx, dbf = writer.close()
+    """
+    SHP_HEADER_SIZE = 100
+
+    def __init__(self, field_names):
+        self.field_names = _fieldNames(field_names)
+        self.shape_type = None
+        self.n_records = 0
+        self.bbox = None
+        self.shp = tempfile.TemporaryFile()
+        self.shx = tempfile.TemporaryFile()
+        self.dbf = tempfile.TemporaryFile()
+        # the headers are filled in by close()
+        self.shp.write("\0" * self.SHP_HEADER_SIZE)
+        self.shx.write("\0" * self.SHP_HEADER_SIZE)
+        self.dbf.write(self._dbfHeader())
+
+    def write(self, values, wkb):
+        """Add a record with the field `values` and the shape in `wkb` (which
+        can be None). Raises ValueError if the shape is a different type than
+        the ones before it"""
+        content = self._shapeContent(wkb)
+        offset = self.shp.tell()
+        self.n_records += 1
+        self.shp.write(struct.pack(">ii", self.n_records, len(content) // 2))
+        self.shp.write(content)
+        self.shx.write(struct.pack(">ii", offset // 2, len(content) // 2))
+
+        record = [" "]
+        for value in values:
+            if value is None:
+                value = ""
+            elif not isinstance(value, unicode):
+                value = unicode(value)
+            # don't cut a multibyte character in half
+            value = value.encode("utf-8")[:FIELD_SIZE].decode("utf-8", "ignore").encode("utf-8")
+            record.append(value.ljust(FIELD_SIZE))
+        self.dbf.write("".join(record))
+
+    def close(self):
+        """Fill in the headers, and return the .shp, .shx and .dbf files,
+        rewound to the beginning"""
+        shape_type = self.shape_type if self.shape_type is not None else NULL
+        bbox = self.bbox or (0.0, 0.0, 0.0, 0.0)
+        for f in [self.shp, self.shx]:
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(0)
+            f.write(struct.pack(">i20xi", 9994, size // 2))
+            f.write(struct.pack("<ii4d32x", 1000, shape_type, *bbox))
+
+        self.dbf.seek(0, 2)
+        self.dbf.write("\x1a")
+        self.dbf.seek(4)
+        self.dbf.write(struct.pack("<I", self.n_records))
+
+        for f in [self.shp, self.shx, self.dbf]:
+            f.seek(0)
+        return self.shp, self.shx, self.dbf
+
+    def _dbfHeader(self):
+        now = time.localtime()
+        header = [struct.pack("<BBBBIHH20x",
+            3,
+            now.tm_year - 1900,
+            now.tm_mon,
+            now.tm_mday,
+            0,
+            32 + 32 * len(self.field_names) + 1,
+            1 + FIELD_SIZE * len(self.field_names),
+        )]
+        for name in self.field_names:
+            header.append(struct.pack("<11sc4xBB14x", name, "C", FIELD_SIZE, 0))
+        header.append("\r")
+        return "".join(header)
+
+    def _shapeContent(self, wkb):
+        """Return the contents of the .shp record for the WKB"""
+        if wkb is None:
+            return struct.pack("<i", NULL)
+
+        wkb = str(wkb)
+        wkb_type, parts = _parseWKB(wkb, 0)[:2]
+        if not parts:
+            return struct.pack("<i", NULL)
+
+        shape_type = WKB_TO_SHAPE_TYPE[wkb_type]
+        if self.shape_type is None:
+            self.shape_type = shape_type
+        elif shape_type == POINT and self.shape_type == MULTIPOINT:
+            # a point can be a multipoint with one point
+            shape_type = MULTIPOINT
+        elif shape_type != self.shape_type:
+            raise ValueError("The geometries aren't all the same type")
+
+        points = "".join(parts)
+        bbox = _boundingBox(points)
+        self._extend(bbox)
+        if shape_type == POINT:
+            return struct.pack("<i", POINT) + points
+        if shape_type == MULTIPOINT:
+            return struct.pack("<i4di", MULTIPOINT, bbox[0], bbox[1], bbox[2], bbox[3], len(points) // 16) + points
+
+        starts = []
+        n_points = 0
+        for part in parts:
+            starts.append(n_points)
+            n_points += len(part) // 16
+        return (
+            struct.pack("<i4dii", shape_type, bbox[0], bbox[1], bbox[2], bbox[3], len(parts), n_points)
+            + struct.pack("<%di" % len(starts), *starts)
+            + points
+        )
+
+    def _extend(self, bbox):
+        if self.bbox is None:
+            self.bbox = bbox
+        else:
+            self.bbox = (
+                min(self.bbox[0], bbox[0]),
+                min(self.bbox[1], bbox[1]),
+                max(self.bbox[2], bbox[2]),
+                max(self.bbox[3], bbox[3]),
+            )
+
+
+def _fieldNames(names):
+    """Cut the names down to the 10 characters a .dbf allows, without ending
+    up with the same name twice"""
+    fields = []
+    for name in names:
+        name = name.encode("utf-8")[:10]
+        i = 1
+        while name in fields:
+            suffix = str(i)
+            name = name[:10 - len(suffix)] + suffix
+            i += 1
+        fields.append(name)
+    return fields
+
+def _parseWKB(wkb, offset):
+    """Parse the WKB geometry at `offset`, and return its type, a list of
+    the little endian X and Y coordinates of each of its parts (points,
+    linestrings or rings) as strings, and the offset it ends at. The
+    coordinates are sliced straight out of the WKB, so this never loops over
+    points"""
+    endian = "<" if wkb[offset] == "\x01" else ">"
+    wkb_type, = struct.unpack_from(endian + "I", wkb, offset + 1)
+    offset += 5
+    if wkb_type == WKB_POINT:
+        part = _littleEndian(wkb[offset:offset + 16], endian)
+        offset += 16
+        # an empty point is written with NaN coordinates
+        x, y = struct.unpack("<2d", part)
+        return wkb_type, [part] if x == x else [], offset
+    elif wkb_type == WKB_LINESTRING:
+        part, offset = _points(wkb, offset, endian)
+        return wkb_type, [part] if part else [], offset
+    elif wkb_type == WKB_POLYGON:
+        n_rings, = struct.unpack_from(endian + "I", wkb, offset)
+        offset += 4
+        parts = []
+        for i in range(n_rings):
+            part, offset = _points(wkb, offset, endian)
+            parts.append(part)
+        return wkb_type, parts, offset
+    elif wkb_type in [WKB_MULTIPOINT, WKB_MULTILINESTRING, WKB_MULTIPOLYGON]:
+        n_geometries, = struct.unpack_from(endian + "I", wkb, offset)
+        offset += 4
+        parts = []
+        for i in range(n_geometries):
+            geometry_parts, offset = _parseWKB(wkb, offset)[1:]
+            parts.extend(geometry_parts)
+        return wkb_type, parts, offset
+    raise ValueError("Unsupported geometry type %d" % wkb_type)
+
+def _points(wkb, offset, endian):
+    """Return a string of the coordinates of the point list at `offset`, and
+    the offset it ends at"""
+    n_points, = struct.unpack_from(endian + "I", wkb, offset)
+    offset += 4
+    return _littleEndian(wkb[offset:offset + 16 * n_points], endian), offset + 16 * n_points
+
+def _littleEndian(coordinates, endian):
+    if endian == "<":
+        return coordinates
+    doubles = array.array("d")
+    doubles.fromstring(coordinates)
+    if sys.byteorder == "little":
+        doubles.byteswap()
+    return doubles.tostring()
+
+def _boundingBox(points):
+    """Return the min X, min Y, max X and max Y of a string of little endian
+    coordinates"""
+    doubles = array.array("d")
+    doubles.fromstring(points)
+    if sys.byteorder == "big":
+        doubles.byteswap()
+    xs = doubles[0::2]
+    ys = doubles[1::2]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class ZipStream(object):
+    """
+    This iterates over the bytes of a zip file of the `members`, which is a
+    list of 2-tuples of the name and a file object to read the contents
+    from. The members are deflated as they are read, and their CRC and sizes
+    are written after them (in a data descriptor), so nothing has to be
+    buffered, and the first bytes can be sent right away. The file objects
+    are closed when they have been read
+    """
+    # the size of the chunks the members are read in
+    CHUNK_SIZE = 64 * 1024
+    # this doesn't write zip64 records, so members and the file have to be
+    # smaller than this
+    MAX_SIZE = 0xffffffff
+
+    def __init__(self, members):
+        self.members = members
+        self.offset = 0
+        self.central_directory = []
+
+    def __iter__(self):
+        try:
+            for name, f in self.members:
+                for chunk in self._member(name, f):
+                    self.offset += len(chunk)
+                    yield chunk
+            yield self._end()
+        finally:
+            for name, f in self.members:
+                f.close()
+
+    def _member(self, name, f):
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        dos_time, dos_date = _dosDateTime(time.localtime())
+        header_offset = self.offset
+        # bit 3 means the CRC and sizes come after the data
+        flags = 0x08
+        yield struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, flags, 8, dos_time, dos_date, 0, 0, 0, len(name), 0) + name
+
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        while True:
+            data = f.read(self.CHUNK_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            data = compressor.compress(data)
+            compressed_size += len(data)
+            if data:
+                yield data
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield data
+
+        if size > self.MAX_SIZE or self.offset + compressed_size > self.MAX_SIZE:
+            raise ValueError("%s is too big to zip" % name)
+
+        crc &= 0xffffffff
+        yield struct.pack("<IIII", 0x08074b50, crc, compressed_size, size)
+        self.central_directory.append(
+            struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 20, 20, flags, 8, dos_time, dos_date, crc, compressed_size, size, len(name), 0, 0, 0, 0, 0644 << 16, header_offset)
+            + name
+        )
+
+    def _end(self):
+        central_directory = "".join(self.central_directory)
+        n = len(self.central_directory)
+        return central_directory + struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, n, n, len(central_directory), self.offset, 0)
+
+
+def _dosDateTime(t):
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
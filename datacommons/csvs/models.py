@@ -1,7 +1,12 @@
+import os
+import mmap
+import array
+import struct
+import cStringIO
 from django.db import models
 from datacommons.importable.models import ImportableUpload
 from datacommons.unicodecsv import UnicodeReader
-from datacommons.utils.dbhelpers import sanitize, inferColumnTypes
+from datacommons.utils.dbhelpers import sanitize, columnTypeInferrer
 
 # Create your models here.
 class CSVImport(ImportableUpload):
@@ -14,19 +19,39 @@ class CSVImport(ImportableUpload):
     class Meta:
         proxy = True
 
-    def parse(self):
-        """Parse a CSV and return the header row, some of the data rows and
-        inferred data types"""
+    @property
+    def index_path(self):
+        """Return the full path to the file that holds the byte offset of every
+        record in the CSV (see RecordIndexer)"""
+        return self.path + ".index"
+
+    def uploadedChunk(self, chunk):
+        if not hasattr(self, "_indexer"):
+            self._indexer = RecordIndexer()
+        self._indexer.feed(chunk)
+
+    def uploadFinished(self):
+        if not hasattr(self, "_indexer"):
+            self._indexer = RecordIndexer()
+        self._indexer.save(self.index_path)
+
+    def parseFile(self):
+        """Parse a CSV and return the header row, some of the data rows,
+        inferred data types and the number of data rows"""
         rows = []
         max_rows = 10
         # read in the first few rows, and save to a buffer.
-        # Continue reading to check for any encoding errors
+        # Continue reading to check for any encoding errors, and to infer the
+        # column types from every row in the file
+        inferrer = columnTypeInferrer()
         i = -1
         try:
             last_row = None
             for i, row in enumerate(self):
                 if i < max_rows:
                     rows.append(row)
+                # empty strings are imported as nulls
+                inferrer.add([col if col != "" else None for col in row])
                 if last_row != None and len(last_row) != len(row):
                     raise ValueError("CSV rows are not all the same length. Or maybe you have an extra newline at the bottom of your file")
                 last_row = row
@@ -39,8 +64,9 @@ class CSVImport(ImportableUpload):
 
         header = [sanitize(c) for c in self.header()]
         data = rows
-        types = inferColumnTypes(data)
-        return header, data, types
+        types = inferrer.types()
+        self.stopwatch.record("inference", inferrer.seconds, rows=i + 1)
+        return header, data, types, i + 1
 
     def header(self):
         with open(self.path, 'r') as csvfile:
@@ -56,4 +82,118 @@ class CSVImport(ImportableUpload):
                 if i == 0: continue
                 yield [col.strip() for col in row]
 
+    def readRows(self, start, stop):
+        """Read the data rows from index `start` up to `stop` by jumping
+        straight to them using the record index"""
+        # record 0 is the header, so data row n is record n + 1
+        span = self._recordSpan(start + 1, stop + 1)
+        if span is None:
+            return super(CSVImport, self).readRows(start, stop)
+
+        reader = UnicodeReader(cStringIO.StringIO(self._readBytes(*span)))
+        return [[col.strip() for col in row] for row in reader]
+
+    def rowsFrom(self, start):
+        """Iterate over the data rows, starting at index `start`, by seeking
+        straight to it using the record index"""
+        span = self._recordSpan(start + 1, start + 1)
+        if span is None:
+            return super(CSVImport, self).rowsFrom(start)
+        return self._rowsAt(span[0])
+
+    def _rowsAt(self, offset):
+        with open(self.path, 'r') as csvfile:
+            csvfile.seek(offset)
+            reader = UnicodeReader(csvfile)
+            for row in reader:
+                yield [col.strip() for col in row]
+
+    def recordContext(self, line):
+        # this is called when the file couldn't be parsed, so the row count
+        # the index is checked against isn't available
+        span = self._recordSpan(line - 1, line, check=False)
+        if span is None:
+            return None
+        return self._readBytes(*span).decode("utf-8", "replace").strip()
+
+    def _recordSpan(self, start, stop, check=True):
+        """Return a 2-tuple of the byte offsets where record `start` begins
+        and record `stop` begins (i.e. where record `stop - 1` ends), or None
+        if the index can't be used. If `check` is False, the index isn't
+        checked against the number of rows the file parses into"""
+        if not os.path.exists(self.index_path):
+            return None
+
+        item_size = struct.calcsize("L")
+        n_records = os.path.getsize(self.index_path) // item_size - 1
+        # the index doesn't agree with how the csv module splits up the file
+        # (with lone carriage returns for line endings, for example)
+        if check and n_records != self.rowCount() + 1:
+            return None
+
+        start = max(0, min(start, n_records))
+        stop = max(start, min(stop, n_records))
+        with open(self.index_path, 'rb') as f:
+            f.seek(start * item_size)
+            begin, = struct.unpack("L", f.read(item_size))
+            f.seek(stop * item_size)
+            end, = struct.unpack("L", f.read(item_size))
+        return begin, end
+
+    def _readBytes(self, begin, end):
+        if begin == end:
+            return ""
+
+        with open(self.path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return m[begin:end]
+            finally:
+                m.close()
+
+
+class RecordIndexer(object):
+    """
+    This builds an index of the byte offset of every record in a CSV while it
+    is fed the file a chunk at a time. A record ends at a newline that isn't
+    inside a quoted field. The index contains the offset where each record
+    starts, followed by the size of the file.
+    """
+    def __init__(self):
+        self.offsets = array.array("L", [0])
+        self.size = 0
+        self.in_quotes = False
+
+    def feed(self, chunk):
+        pos = 0
+        next_quote = chunk.find('"')
+        while True:
+            if self.in_quotes:
+                # skip to the closing quote. An escaped quote ("") just
+                # closes and reopens the field
+                if next_quote == -1:
+                    break
+                self.in_quotes = False
+                pos = next_quote + 1
+                next_quote = chunk.find('"', pos)
+            else:
+                newline = chunk.find('\n', pos)
+                if newline != -1 and (next_quote == -1 or newline < next_quote):
+                    self.offsets.append(self.size + newline + 1)
+                    pos = newline + 1
+                elif next_quote != -1:
+                    self.in_quotes = True
+                    pos = next_quote + 1
+                    next_quote = chunk.find('"', pos)
+                else:
+                    break
+
+        self.size += len(chunk)
+
+    def save(self, path):
+        # the last record might not end with a newline
+        if self.offsets[-1] != self.size:
+            self.offsets.append(self.size)
 
+        with open(path, 'wb') as f:
+            self.offsets.tofile(f)
@@ -1,3 +1,15 @@
 from django.contrib import admin
+from .models import ImportableUpload, ImportPhase
 
-# Register your models here.
+class ImportPhaseInline(admin.TabularInline):
+    model = ImportPhase
+    fields = readonly_fields = ("name", "seconds", "rows", "bytes", "rowsPerSecond", "created_on")
+    extra = 0
+    can_delete = False
+
+class ImportableUploadAdmin(admin.ModelAdmin):
+    list_display = ("upload_id", "__unicode__", "mode", "status", "rows_processed", "started_on", "finished_on")
+    list_filter = ("status", "mode")
+    inlines = [ImportPhaseInline]
+
+admin.site.register(ImportableUpload, ImportableUploadAdmin)
@@ -1,6 +1,7 @@
 import shapefile
 import datetime
 from django import forms
+from django.conf import settings as SETTINGS
 from django.forms.forms import BoundField
 from django.forms.widgets import RadioSelect
 from django.db import DatabaseError, transaction
@@ -60,7 +61,11 @@ class ImportableUploadForm(BetterForm):
         try:
             self.model.parse()
         except UnicodeDecodeError as e:
-            raise forms.ValidationError("The file has corrupt characters on line %d. Edit the file and remove or replace the invalid characters" % (e.line))
+            message = "The file has corrupt characters on line %d. Edit the file and remove or replace the invalid characters" % (e.line)
+            context = self.model.recordContext(e.line)
+            if context:
+                message += ". The line looks like: %s" % (context[:200])
+            raise forms.ValidationError(message)
         except shapefile.ShapefileException as e:
             raise forms.ValidationError("Could not import shapefile: %s" % str(e))
         except ValueError as e:
@@ -153,6 +158,12 @@ class ImportableUploadForm(BetterForm):
             if len(pks) != len(header):
                 self._errors['file'] = self.error_class(['The number of columns in the CSV must match the number of primary keys in the table you selected'])
 
+        # the rows deleted in replace mode are recorded in the audit table by
+        # their primary key
+        if len(self._errors) == 0 and mode in [ImportableUpload.REPLACE]:
+            if not getPrimaryKeysForTable(schema, table):
+                self._errors['table'] = self.error_class(['The table you selected has no primary key, so its rows can not be replaced'])
+
     def clean(self):
         cleaned_data = super(ImportableUploadForm, self).clean()
 
@@ -194,6 +205,8 @@ class ImportableUploadForm(BetterForm):
             self.model.table = t
 
         self.model.save()
+        # record how long the upload and parsing took
+        self.model.savePhases()
         return self.model
 
 class ImportablePreviewForm(BetterForm):
@@ -201,7 +214,9 @@ class ImportablePreviewForm(BetterForm):
     in their uploaded CSV (see ImportableUploadForm) IF they are creating a new table. 
     Or this form allows them to select which existing columns in the table
     match up with their uploaded CSV"""
-    # we add all the fields dynamically here
+    chunked = forms.BooleanField(required=False, initial=False, label="Commit the rows %d at a time, so a failed import can be resumed" % ImportableUpload.CHUNK_SIZE)
+
+    # we add all the other fields dynamically here
     def __init__(self, *args, **kwargs):
         self.model = kwargs.pop("model")
         super(ImportablePreviewForm, self).__init__(*args, **kwargs)
@@ -322,24 +337,16 @@ class ImportablePreviewForm(BetterForm):
             model.table.name = self.cleaned_data['table']
             model.table.save()
 
-            with transaction.atomic():
-                self._createTable(model.table)
-                self.model.importInto(self._columns())
-
-            model.table.created_on = datetime.datetime.now()
-            model.table.save()
-
-        elif model.mode in [ImportableUpload.APPEND, ImportableUpload.UPSERT, ImportableUpload.DELETE, ImportableUpload.REPLACE]:
-            # insert all the data
-            with transaction.atomic():
-                self.model.importInto(self._columns())
-
-        model.status = model.DONE
-        model.save()
-
-    def _createTable(self, table):
-        columns = self._columns()
-        table.create(columns)
+        model.setColumns(self._columns())
+        model.chunked = self.cleaned_data.get('chunked', False)
+        if SETTINGS.BACKGROUND_IMPORTS:
+            # leave it for the runimports management command
+            model.status = model.QUEUED
+            model.rows_processed = 0
+            model.error = ""
+            model.save()
+        else:
+            model.runImport()
 
     def _columns(self):
         """Construct a list of schemata.Column objects that represent the
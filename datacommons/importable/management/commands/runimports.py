@@ -0,0 +1,42 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from datacommons.importable.models import ImportableUpload
+
+class Command(BaseCommand):
+    help = "Run the queued imports, one at a time. This should be run alongside the web server when BACKGROUND_IMPORTS is on"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--once", action="store_true", dest="once", default=False,
+            help="Exit when there are no more queued imports, instead of waiting for more"),
+        make_option("--interval", type="float", dest="interval", default=2.0,
+            help="The number of seconds to wait between checks for queued imports"),
+        make_option("--requeue", action="store_true", dest="requeue", default=False,
+            help="Queue up the imports left running by a worker that was interrupted. Chunked imports resume from their last commit. "
+                "Every running import is requeued, so this must only be used when no other worker is running"),
+    )
+
+    def handle(self, *args, **options):
+        if options['requeue']:
+            # there is no way to tell an import held by a live worker from
+            # one whose worker died, so this assumes there are no live
+            # workers (see the help for --requeue)
+            n = ImportableUpload.objects.filter(status=ImportableUpload.RUNNING).update(status=ImportableUpload.QUEUED)
+            self.stdout.write("Requeued %d interrupted imports" % n)
+
+        while True:
+            upload = ImportableUpload.claimNext()
+            if upload is None:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write("Importing upload %d into %s" % (upload.pk, upload))
+            try:
+                upload.runImport()
+            except Exception as e:
+                # the error is recorded on the upload, so the user can see it
+                self.stderr.write("Upload %d failed: %s" % (upload.pk, e))
+            else:
+                self.stdout.write("Upload %d is done" % (upload.pk))
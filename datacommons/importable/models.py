@@ -1,9 +1,14 @@
 import uuid
 import os
+import itertools
+import json
 from django.conf import settings as SETTINGS
 from django.db import models, transaction, DatabaseError
-from datacommons.schemas.models import ColumnTypes, Version, TableMutator
+from django.utils import timezone
+from datacommons.schemas.models import ColumnTypes, Column, Version, TableMutator, TableLoader
 from datacommons.accounts.models import User
+from datacommons.jsonencoder import JSONEncoder
+from datacommons.utils.stopwatch import Stopwatch
 
 class ImportableUpload(models.Model):
     """This class represents a file in the process of being uploaded and
@@ -17,15 +22,35 @@ class ImportableUpload(models.Model):
     DELETE = 4
     REPLACE = 5
 
+    # the modes that are imported with the bulk loader by default
+    BULK_MODES = [CREATE, APPEND, UPSERT, DELETE, REPLACE]
+
     # status enums
+    QUEUED = 1
+    RUNNING = 2
     DONE = 4
     PENDING = 8
+    FAILED = 16
+    # a failed chunked import the user gave up on (see abandon)
+    ABANDONED = 32
+
+    # how often (in rows) the progress of an import is recorded
+    PROGRESS_INTERVAL = 1000
+    # how many rows are committed at a time by a chunked import
+    CHUNK_SIZE = 50000
 
     upload_id = models.AutoField(primary_key=True)
     created_on = models.DateTimeField(auto_now_add=True)
     # filename relative to MEDIA_ROOT
     filename = models.CharField(max_length=255)
-    status = models.IntegerField(choices=((DONE, "Done"), (PENDING, "Pending")), default=PENDING)
+    status = models.IntegerField(choices=(
+        (PENDING, "Pending"),
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+        (ABANDONED, "Abandoned"),
+    ), default=PENDING)
     mode = models.IntegerField(choices=(
         (APPEND, "Append"), 
         (CREATE, "Create"),
@@ -37,6 +62,24 @@ class ImportableUpload(models.Model):
     table = models.ForeignKey('schemas.Table')
     user = models.ForeignKey(User, related_name='+', null=True, default=None)
 
+    # the "app_label.ModelName" of the subclass that uploaded the file, so a
+    # worker knows how to read it
+    importer = models.CharField(max_length=255, default="")
+    # JSON list of the columns to import into (see setColumns)
+    columns = models.TextField(default="")
+    rows_processed = models.IntegerField(default=0)
+    error = models.TextField(default="")
+    started_on = models.DateTimeField(null=True, default=None)
+    finished_on = models.DateTimeField(null=True, default=None)
+
+    # a chunked import commits every CHUNK_SIZE rows, instead of importing the
+    # whole file in one transaction (see chunkedImportInto). The version every
+    # chunk is imported under, and the number of rows committed so far are
+    # kept, so a failed import can be resumed
+    chunked = models.BooleanField(default=False)
+    version = models.ForeignKey('schemas.Version', related_name='+', null=True, default=None)
+    checkpoint_row = models.IntegerField(default=0)
+
     class Meta:
         db_table = 'csv' # TODO rename
 
@@ -48,6 +91,21 @@ class ImportableUpload(models.Model):
         """Return the full path to the file this object represents"""
         return os.path.join(SETTINGS.MEDIA_ROOT, self.filename)
 
+    @property
+    def stopwatch(self):
+        """The Stopwatch that times each phase of uploading and importing the
+        file. The phases are saved to the DB by savePhases()"""
+        if not hasattr(self, "_stopwatch"):
+            self._stopwatch = Stopwatch()
+        return self._stopwatch
+
+    def savePhases(self):
+        """Save the phases timed so far as ImportPhase objects, and start
+        over"""
+        for name, phase in self.stopwatch.phases.items():
+            ImportPhase.objects.create(upload=self, name=name, **phase)
+        self._stopwatch = Stopwatch()
+
 
     """
     Subclasses need to provide a way to upload the file, a way to parse the
@@ -64,22 +122,223 @@ class ImportableUpload(models.Model):
 
         filename = str(uuid.uuid4().hex) + ".tmp"
         path = os.path.join(SETTINGS.MEDIA_ROOT, filename)
-        with open(path, 'wb+') as dest:
-            for chunk in f.chunks():
-                dest.write(chunk)
+        importable = cls(filename=filename, importer="%s.%s" % (cls._meta.app_label, cls._meta.object_name))
+        with importable.stopwatch.time("upload", bytes=0) as counts:
+            with open(path, 'wb+') as dest:
+                for chunk in f.chunks():
+                    dest.write(chunk)
+                    importable.uploadedChunk(chunk)
+                    counts['bytes'] += len(chunk)
+            importable.uploadFinished()
+
+        return importable
+
+    @classmethod
+    def claimNext(cls):
+        """Mark the oldest queued upload as running and return it (as an
+        instance of the subclass that uploaded it). Returns None if nothing is
+        queued. Uploads that don't say which subclass uploaded them (which
+        is every upload made before the importer field was added) can't be
+        read, so they are marked as FAILED and skipped"""
+        while True:
+            with transaction.atomic():
+                queued = list(cls.objects.select_for_update().filter(status=cls.QUEUED).order_by("upload_id")[:1])
+                if not queued:
+                    return None
+                upload = queued[0]
+                model = None
+                if "." in upload.importer:
+                    model = models.get_model(*upload.importer.split(".", 1))
+                if model is None:
+                    upload.status = cls.FAILED
+                    upload.error = "This file can't be imported in the background. Upload it again"
+                    upload.finished_on = timezone.now()
+                    upload.save()
+                    continue
+
+                upload.status = cls.RUNNING
+                upload.started_on = timezone.now()
+                upload.save()
+
+            return model.objects.get(pk=upload.pk)
+
+    def setColumns(self, columns):
+        """Save the list of schemas.Column objects the file will be imported
+        into, so the import can be run later"""
+        self.columns = json.dumps([{
+            "name": col.name,
+            "type": col.type,
+            "is_pk": col.is_pk,
+            "srid": col.srid,
+            "geom_type": col.geom_type,
+        } for col in columns])
+
+    def getColumns(self):
+        """Return the list of schemas.Column objects set by setColumns"""
+        return [Column(**col) for col in json.loads(self.columns)]
+
+    def canResume(self):
+        """Return True if this is a failed chunked import that committed some
+        of its data, which can only be finished by resuming it"""
+        return self.status == self.FAILED and self.chunked and self.version_id is not None
+
+    def abandon(self):
+        """Give up on a failed chunked import that can't be resumed (because
+        of bad data in the file, say). The rows that were committed stay in
+        the table, under the import's version, so they can be rolled back by
+        restoring the version before it. In CREATE mode, the table is marked
+        as created, so it can be imported into again, or restored"""
+        with transaction.atomic():
+            if self.mode == self.CREATE:
+                self.table.created_on = timezone.now()
+                self.table.save()
+
+            self.status = self.ABANDONED
+            self.finished_on = timezone.now()
+            self.save()
+
+    def previousVersion(self):
+        """Return the version of the table from before this import's version,
+        or None"""
+        versions = list(Version.objects.filter(table_id=self.table_id, pk__lt=self.version_id).order_by("-pk")[:1])
+        return versions[0] if versions else None
 
-        return cls(filename=filename)
+    def runImport(self):
+        """Import the file using the columns set by setColumns (creating the
+        table first in CREATE mode), and record how it went in the status
+        field. Exceptions are re-raised after the upload is marked as FAILED.
+        Chunked imports pick up where they left off"""
+        columns = self.getColumns()
+        self.status = self.RUNNING
+        self.started_on = self.started_on or timezone.now()
+        self.rows_processed = self.checkpoint_row
+        self.error = ""
+        self.save()
+
+        try:
+            # whatever time isn't spent in the phases inside the transactions
+            # is spent committing them
+            with self.stopwatch.time("commit"):
+                if self.chunked:
+                    self.chunkedImportInto(columns)
+                    with transaction.atomic():
+                        self._finishImport()
+                else:
+                    with transaction.atomic():
+                        if self.mode == self.CREATE:
+                            with self.stopwatch.time("create"):
+                                self.table.create(columns)
+                        self.importInto(columns)
+                        self._finishImport()
+        except Exception as e:
+            self.status = self.FAILED
+            self.error = str(e)
+            self.finished_on = timezone.now()
+            self.save()
+            raise
+        finally:
+            self.savePhases()
+
+    def _finishImport(self):
+        if self.mode == self.CREATE:
+            self.table.created_on = timezone.now()
+            self.table.save()
+
+        self.status = self.DONE
+        self.finished_on = timezone.now()
+        self.save()
+
+    def _reportProgress(self, rows_processed):
+        """Record how many rows have been imported. This is done on the
+        "progress" database connection, so it is visible while the import's
+        transaction is still open"""
+        self.rows_processed = rows_processed
+        ImportableUpload.objects.using("progress").filter(pk=self.pk).update(rows_processed=rows_processed)
+
+    def uploadedChunk(self, chunk):
+        """This is called with each chunk of the file as it is written to disk
+        by upload(), so subclasses can look at the file while it streams in"""
+        pass
+
+    def uploadFinished(self):
+        """This is called after the whole file has been written to disk by
+        upload()"""
+        pass
+
+    @property
+    def parsed_path(self):
+        """Return the full path to the file the result of parse() is cached in"""
+        return self.path + ".parsed"
 
     def parse(self):
-        """Parse a file and return the header row, some of the data rows and
-        inferred data types.
+        """Return the header row, some of the data rows and inferred data types
+        of the file (see parseFile). The file is only actually parsed once;
+        the result is cached in a file next to it, and is thrown out if the
+        file changes"""
+        parsed = self._parsed()
+        return parsed['header'], parsed['data'], parsed['types']
+
+    def rowCount(self):
+        """Return the number of data rows in the file"""
+        return self._parsed()['row_count']
+
+    def readRows(self, start, stop):
+        """Return a list of the data rows from index `start` up to (but not
+        including) index `stop`. Subclasses that can seek to a row should
+        override this, since this reads every row before `start`"""
+        return list(itertools.islice(self, start, stop))
+
+    def recordContext(self, line):
+        """Return the text of `line` of the file (starting at 1) for use in
+        error messages, or None if that isn't possible"""
+        return None
+
+    def parseFile(self):
+        """Parse a file and return the header row, some of the data rows,
+        inferred data types and the number of data rows.
 
         For example, a CSV file would return something like
 
-        return ["id", "name"], [[1, "Matt"], [13, "John"]], [ColumnTypes.INTEGER, ColumnTypes.TEXT]
+        return ["id", "name"], [[1, "Matt"], [13, "John"]], [ColumnTypes.INTEGER, ColumnTypes.TEXT], 2
         """
         
-        raise NotImplementedError("You must implement the parse method")
+        raise NotImplementedError("You must implement the parseFile method")
+
+    def _parsed(self):
+        """Return the (possibly cached) result of parseFile as a dict"""
+        stat = os.stat(self.path)
+        signature = [stat.st_size, stat.st_mtime]
+
+        parsed = getattr(self, "_parse_cache", None)
+        if parsed is None and os.path.exists(self.parsed_path):
+            try:
+                with open(self.parsed_path) as f:
+                    parsed = json.load(f)
+            except ValueError:
+                # the cache file is corrupt
+                parsed = None
+
+        if parsed is None or parsed['signature'] != signature:
+            with self.stopwatch.time("parse", bytes=stat.st_size) as counts:
+                header, data, types, row_count = self.parseFile()
+                counts['rows'] = row_count
+            parsed = {
+                "signature": signature,
+                "header": header,
+                "data": data,
+                "types": types,
+                "row_count": row_count,
+            }
+            try:
+                with open(self.parsed_path, 'w') as f:
+                    json.dump(parsed, f, cls=JSONEncoder)
+            except (TypeError, ValueError, UnicodeDecodeError):
+                # the data can't be represented as JSON, so it can only be
+                # cached in memory
+                os.remove(self.parsed_path)
+
+        self._parse_cache = parsed
+        return parsed
 
     def __iter__(self):
         """
@@ -93,47 +352,259 @@ class ImportableUpload(models.Model):
         """
         raise NotImplementedError("You must implement the __iter__ method")
 
-    def importInto(self, columns):
-        """Read a file and insert into schema_name.table_name"""
-        with transaction.atomic():
+    def importInto(self, columns, bulk=None):
+        """Read a file and insert into schema_name.table_name. If `bulk` is
+        True, the rows are loaded in batches with COPY (see TableLoader),
+        otherwise they are inserted one by one. By default, the bulk loader is
+        used for the modes in BULK_MODES"""
+        if bulk is None:
+            bulk = self.mode in self.BULK_MODES
+
+        # the time that isn't spent in the phases run by the loaders is spent
+        # reading the file
+        with transaction.atomic(), self.stopwatch.time("read") as counts:
             # create a new version for the table
             version = Version(user=self.user, table=self.table)
             version.save()
 
-            tm = TableMutator(version, columns)
-            do_insert = self.mode in [ImportableUpload.CREATE, ImportableUpload.APPEND, ImportableUpload.UPSERT, ImportableUpload.REPLACE]
-            do_delete = self.mode in [ImportableUpload.UPSERT, ImportableUpload.DELETE]
+            if bulk:
+                self._bulkImportInto(version, columns)
+            else:
+                self._rowImportInto(version, columns)
+            counts['rows'] = self.rows_processed
+
+    def _bulkImportInto(self, version, columns):
+        """Load the rows in batches using COPY"""
+        loader = TableLoader(version, columns, stopwatch=self.stopwatch)
+        tm = TableMutator(version, columns, stopwatch=self.stopwatch)
 
+        try:
+            if self.mode == ImportableUpload.REPLACE:
+                # delete every existing row
+                tm.deleteAllRows()
+        except DatabaseError as e:
+            raise DatabaseError("Tried to delete all rows, got this `%s`. SQL was: `%s`:" % (
+                str(e),
+                e.sql,
+            ))
 
-            # execute the query string for every row
+        # in UPSERT and DELETE mode, the whole file is staged first, and then
+        # applied with a few set based statements
+        apply_staged = self.mode in [ImportableUpload.UPSERT, ImportableUpload.DELETE]
+
+        row_i = 0
+        for batch in loader.batches(self._cleanedRows()):
             try:
-                if self.mode == ImportableUpload.REPLACE:
-                    # delete every existing row
-                    tm.deleteAllRows()
+                if apply_staged:
+                    loader.stageRows(batch)
+                else:
+                    loader.insertRows(batch)
             except DatabaseError as e:
-                raise DatabaseError("Tried to delete all rows, got this `%s`. SQL was: `%s`:" % (
+                raise DatabaseError("Tried to insert lines %d to %d of the data, got this `%s`. SQL was: `%s`:" % (
+                    row_i+1,
+                    row_i+len(batch),
                     str(e),
                     e.sql,
                 ))
+            row_i += len(batch)
+            self._reportProgress(row_i)
 
+        if apply_staged:
             try:
-                for row_i, row in enumerate(self):
-                    # convert empty strings to null
-                    for col_i, col in enumerate(row):
-                        row[col_i] = col if col != "" else None
-
-                    if do_delete:
-                        # extract out the PKs from the row
-                        params = [item for item, col in zip(row, columns) if col.is_pk]
-                        tm.deleteRow(params)
-
-                    if do_insert:
-                        tm.insertRow(row)
+                loader.analyzeStagedRows()
+                if self.mode == ImportableUpload.UPSERT:
+                    loader.dedupeStagedRows()
+                loader.deleteStagedRows()
+                if self.mode == ImportableUpload.UPSERT:
+                    loader.insertStagedRows()
             except DatabaseError as e:
-                raise DatabaseError("Tried to insert line %d of the data, got this `%s`. SQL was: `%s`:" % (
-                    row_i+1,
+                raise DatabaseError("Tried to apply the data, got this `%s`. SQL was: `%s`:" % (
                     str(e),
                     e.sql,
                 ))
 
+        loader.close()
+
+    def chunkedImportInto(self, columns):
+        """Import the file like importInto does with the bulk loader, but
+        commit every CHUNK_SIZE rows, and record the number of rows committed
+        in checkpoint_row. If the import fails, calling this again resumes it
+        from the last commit.
+
+        Every chunk is imported under the same version, and each chunk's audit
+        rows are committed along with it, so the audit history ends up the
+        same as if the file was imported in one go. The table is created (in
+        CREATE mode) and emptied (in REPLACE mode) in the first transaction.
+        In UPSERT and DELETE mode, the rows are applied a batch at a time
+        instead of all at once. If a primary key is in the file more than
+        once, the last row wins, whether or not the rows are in the same
+        batch"""
+        if self.version_id is None:
+            with transaction.atomic():
+                if self.mode == self.CREATE:
+                    with self.stopwatch.time("create"):
+                        self.table.create(columns)
+
+                version = Version(user=self.user, table=self.table)
+                version.save()
+
+                if self.mode == ImportableUpload.REPLACE:
+                    tm = TableMutator(version, columns, stopwatch=self.stopwatch)
+                    try:
+                        tm.deleteAllRows()
+                    except DatabaseError as e:
+                        raise DatabaseError("Tried to delete all rows, got this `%s`. SQL was: `%s`:" % (
+                            str(e),
+                            e.sql,
+                        ))
+
+                ImportableUpload.objects.filter(pk=self.pk).update(version=version, checkpoint_row=0)
+            self.version = version
+            self.checkpoint_row = 0
+
+        loader = TableLoader(self.version, columns, stopwatch=self.stopwatch)
+        batches_per_chunk = max(1, self.CHUNK_SIZE // loader.BATCH_SIZE)
+        with self.stopwatch.time("read") as counts:
+            batches = loader.batches(self._cleanedRows(self.checkpoint_row))
+            while True:
+                # the checkpoint is only moved forward once the chunk is
+                # committed, so it is never ahead of the data
+                with transaction.atomic():
+                    row_i = self.checkpoint_row
+                    for batch in itertools.islice(batches, batches_per_chunk):
+                        self._applyBatch(loader, batch, row_i)
+                        row_i += len(batch)
+                        self._reportProgress(row_i)
+
+                    if row_i == self.checkpoint_row:
+                        break
+                    ImportableUpload.objects.filter(pk=self.pk).update(checkpoint_row=row_i)
+                self.checkpoint_row = row_i
+            counts['rows'] = self.checkpoint_row
+
+        loader.close()
+
+    def _applyBatch(self, loader, batch, row_i):
+        """Insert, upsert or delete (depending on the mode) a batch of rows,
+        starting at row `row_i` of the file"""
+        try:
+            if self.mode in [ImportableUpload.UPSERT, ImportableUpload.DELETE]:
+                loader.stageRows(batch)
+                loader.analyzeStagedRows()
+                if self.mode == ImportableUpload.UPSERT:
+                    loader.dedupeStagedRows()
+                loader.deleteStagedRows()
+                if self.mode == ImportableUpload.UPSERT:
+                    loader.insertStagedRows()
+                loader.clearStagedRows()
+            else:
+                loader.insertRows(batch)
+        except DatabaseError as e:
+            raise DatabaseError("Tried to insert lines %d to %d of the data, got this `%s`. SQL was: `%s`:" % (
+                row_i+1,
+                row_i+len(batch),
+                str(e),
+                e.sql,
+            ))
+
+    def _rowImportInto(self, version, columns):
+        """Insert (and delete) the rows one at a time"""
+        tm = TableMutator(version, columns, stopwatch=self.stopwatch)
+        do_insert = self.mode in [ImportableUpload.CREATE, ImportableUpload.APPEND, ImportableUpload.UPSERT, ImportableUpload.REPLACE]
+        do_delete = self.mode in [ImportableUpload.UPSERT, ImportableUpload.DELETE]
+
+        # execute the query string for every row
+        try:
+            if self.mode == ImportableUpload.REPLACE:
+                # delete every existing row
+                tm.deleteAllRows()
+        except DatabaseError as e:
+            raise DatabaseError("Tried to delete all rows, got this `%s`. SQL was: `%s`:" % (
+                str(e),
+                e.sql,
+            ))
+
+        row_i = -1
+        try:
+            for row_i, row in enumerate(self._cleanedRows()):
+                if do_delete:
+                    # extract out the PKs from the row
+                    params = [item for item, col in zip(row, columns) if col.is_pk]
+                    tm.deleteRow(params)
+
+                if do_insert:
+                    tm.insertRow(row)
+
+                if (row_i + 1) % self.PROGRESS_INTERVAL == 0:
+                    self._reportProgress(row_i + 1)
+        except DatabaseError as e:
+            raise DatabaseError("Tried to insert line %d of the data, got this `%s`. SQL was: `%s`:" % (
+                row_i+1,
+                str(e),
+                e.sql,
+            ))
+        self._reportProgress(row_i + 1)
+
+    def rowsFrom(self, start):
+        """Iterate over the data rows, starting at index `start`. Subclasses
+        that can seek to a row should override this"""
+        return itertools.islice(self, start, None)
+
+    def _cleanedRows(self, start=0):
+        """Iterate over the rows (starting at index `start`), converting empty
+        strings to null"""
+        for row in (self.rowsFrom(start) if start else self):
+            for col_i, col in enumerate(row):
+                row[col_i] = col if col != "" else None
+            yield row
+
+
+class UploadRows(object):
+    """This class wraps up an ImportableUpload so its data rows can be
+    paginated over with a Django Paginator"""
+    def __init__(self, upload):
+        self.upload = upload
+
+    def count(self):
+        return self.upload.rowCount()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.upload.readRows(key.start, key.stop)
+        else:
+            raise NotImplementedError("This class only supports __getitem__ via slicing")
+
+
+class ImportPhase(models.Model):
+    """This records how long one phase of uploading or importing a file took,
+    and how many rows and bytes it handled (see ImportableUpload.stopwatch)"""
+    import_phase_id = models.AutoField(primary_key=True)
+    upload = models.ForeignKey(ImportableUpload, related_name="phases")
+    name = models.CharField(max_length=255)
+    seconds = models.FloatField()
+    rows = models.IntegerField(null=True, default=None)
+    bytes = models.BigIntegerField(null=True, default=None)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'importphase'
+        ordering = ['import_phase_id']
+
+    def __unicode__(self):
+        return u'%s: %.3fs' % (self.name, self.seconds)
+
+    def rowsPerSecond(self):
+        if self.rows is None or self.seconds <= 0:
+            return None
+        return self.rows / self.seconds
+    rowsPerSecond.short_description = "Rows/sec"
 
+    def toJSON(self):
+        return {
+            "name": self.name,
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "rows_per_second": self.rowsPerSecond(),
+            "created_on": self.created_on,
+        }
@@ -7,11 +7,12 @@ from django.contrib.auth.decorators import login_required
 from django.db import DatabaseError
 from django.core.exceptions import PermissionDenied
 from django.contrib import messages
+from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from datacommons.utils.dbhelpers import (
     getDatabaseTopology,
     getColumnsForTable,
 )
-from .models import ColumnTypes, ImportableUpload
+from .models import ColumnTypes, ImportableUpload, UploadRows
 from datacommons.jsonencoder import JSONEncoder
 
 def upload(request, form_class, template_name, redirect_to, filetype):
@@ -42,10 +43,35 @@ def preview(request, form_class, template_name):
     # authorized to view this upload?
     if model.user.pk != request.user.pk:
         raise PermissionDenied()
-    if model.status == model.DONE:
+    if model.status in [model.DONE, model.ABANDONED]:
         raise PermissionDenied()
 
-    error = None
+    # the import is running in the background, so show its progress
+    if model.status in [model.QUEUED, model.RUNNING]:
+        return render(request, 'importable/progress.html', {
+            'upload': model,
+            'row_count': model.rowCount(),
+        })
+
+    error = model.error if model.status == model.FAILED else None
+
+    # part of the data was committed, so the import can't be changed, only
+    # resumed or abandoned
+    if model.canResume():
+        if request.POST.get("resume"):
+            resume(model)
+            return HttpResponseRedirect(request.path + "?upload_id=" + str(model.pk))
+        if request.POST.get("abandon"):
+            model.abandon()
+            messages.info(request, "The import was abandoned. The %d rows that were imported before it failed are still in the table" % model.checkpoint_row)
+            return HttpResponseRedirect(reverse('schemas-show', args=(model.table.schema, model.table.name)))
+
+        previous_version = model.previousVersion()
+        return render(request, 'importable/resume.html', {
+            'upload': model,
+            'error': error,
+            'previous_version': previous_version if previous_version and model.table.canRestore(request.user) else None,
+        })
     
     if request.POST:
         form = form_class(request.POST, model=model)
@@ -55,13 +81,23 @@ def preview(request, form_class, template_name):
             except DatabaseError as e:
                 error = str(e)
             else:
+                if model.status == model.QUEUED:
+                    return HttpResponseRedirect(request.path + "?upload_id=" + str(model.pk))
                 messages.success(request, "You successfully imported the file!")
                 return HttpResponseRedirect(reverse('schemas-show', args=(model.table.schema, model.table.name)))
     else:
         form = form_class(model=model)
 
-    # fetch the meta data about the shapfile
-    column_names, data, column_types = form.model.parse()
+    # page through the data rows in the file
+    paginator = Paginator(UploadRows(model), 10)
+    page = request.GET.get("page")
+    try:
+        data = paginator.page(page)
+    except PageNotAnInteger:
+        data = paginator.page(1)
+    except EmptyPage:
+        data = paginator.page(paginator.num_pages)
+
     # grab the columns from the existing table
     if model.mode == ImportableUpload.APPEND:
         existing_columns = getColumnsForTable(model.table.schema, model.table.name)
@@ -77,3 +113,63 @@ def preview(request, form_class, template_name):
         'col_name_to_human_type_json': json.dumps(name_to_human_type),
         'form': form,
     })
+
+def resume(model):
+    """Resume a failed chunked import, in the background if
+    BACKGROUND_IMPORTS is on"""
+    if SETTINGS.BACKGROUND_IMPORTS:
+        model.status = model.QUEUED
+        model.save()
+    else:
+        try:
+            model.runImport()
+        except Exception:
+            # runImport saves the error on the model (and marks it as FAILED)
+            # before re-raising it, and it is shown on the resume page
+            pass
+
+@login_required
+def status(request, upload_id):
+    """Return the status of an import as JSON, so its progress can be
+    polled"""
+    model = get_object_or_404(ImportableUpload, pk=upload_id)
+    if model.user_id != request.user.pk:
+        raise PermissionDenied()
+
+    data = {
+        "status": model.status,
+        "status_label": model.get_status_display(),
+        "rows_processed": model.rows_processed,
+        "error": model.error,
+        "started_on": model.started_on,
+        "finished_on": model.finished_on,
+    }
+    if model.status == model.DONE:
+        data["redirect_to"] = reverse('schemas-show', args=(model.table.schema, model.table.name))
+
+    return HttpResponse(json.dumps(data, cls=JSONEncoder), content_type="application/json")
+
+@login_required
+def telemetry(request, upload_id):
+    """Return the time spent in each phase of uploading and importing a file
+    as JSON"""
+    model = get_object_or_404(ImportableUpload, pk=upload_id)
+    if model.user_id != request.user.pk and not request.user.is_staff:
+        raise PermissionDenied()
+
+    phases = list(model.phases.all())
+    seconds = sum(phase.seconds for phase in phases)
+    data = {
+        "upload_id": model.pk,
+        "table": unicode(model),
+        "mode": model.get_mode_display(),
+        "status": model.get_status_display(),
+        "rows_processed": model.rows_processed,
+        "seconds": seconds,
+        "rows_per_second": model.rows_processed / seconds if seconds > 0 else None,
+        "started_on": model.started_on,
+        "finished_on": model.finished_on,
+        "phases": phases,
+    }
+
+    return HttpResponse(json.dumps(data, cls=JSONEncoder), content_type="application/json")
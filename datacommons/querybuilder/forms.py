@@ -40,7 +40,7 @@ class CreateViewForm(BetterForm):
         sql = self.cleaned_data['sql']
         try:
             sql = sanitizeSelectSQL(sql)
-            SQLHandle(sql).count()
+            SQLHandle(sql).describe()
         except (DatabaseError, ValueError) as e:
             raise forms.ValidationError(str(e))
         return sql
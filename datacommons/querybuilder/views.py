@@ -11,23 +11,17 @@ from django.db.models import Q
 from django.db import DatabaseError
 from datacommons.utils.dbhelpers import (
     fetchRowsFor,
-    getDatabaseTopology,
     SQLHandle,
+    SQLPaginator,
     sanitizeSelectSQL
 )
 from datacommons.schemas.models import ColumnTypes, Table, TablePermission, Version, View
 from .forms import CreateViewForm
-from datacommons.jsonencoder import JSONEncoder
 
 def build(request):
-    meta = getDatabaseTopology(owner=request.user)
-    # filter out all views not owned by this user
-    for schema in meta:
-        schema.views = [v for v in schema.views if getattr(v, 'owner_id') == request.user.pk]
-
-    return render(request, "querybuilder/build.html", {
-        "schemata": json.dumps(meta, cls=JSONEncoder),
-    })
+    # the schemas, tables and columns are loaded from the catalog views as
+    # they are needed
+    return render(request, "querybuilder/build.html", {})
 
 
 def preview(request, sql):
@@ -42,7 +36,7 @@ def preview(request, sql):
 
     # if we are here, we can assume the SQL is safe (hopefully!)
     q = SQLHandle(sql)
-    paginator = Paginator(q, 100)
+    paginator = SQLPaginator(q, 100)
     error = None
     rows = None
 
@@ -0,0 +1,142 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from datacommons.accounts.models import User
+from datacommons.schemas.models import TableOrView, AUDIT_SCHEMA_NAME
+from datacommons.utils.dbhelpers import _queryTopologyRows, invalidateTopology
+
+# the prefix of the schemas this creates (and drops when it is done)
+SCHEMA_PREFIX = "benchmark_topology_"
+
+# the number of tables in each schema
+TABLES_PER_SCHEMA = 10
+
+# the topology query from before it was rewritten against the system catalogs,
+# to compare against
+LEGACY_TOPOLOGY_SQL = """
+    SELECT
+        nspname,
+        t.name,
+        t.is_view,
+        c.column_name,
+        CASE WHEN c.data_type = 'USER-DEFINED' THEN 'geometry' ELSE c.data_type END AS data_type,
+        pks.constraint_type,
+        CASE WHEN c.data_type = 'USER-DEFINED' AND not t.is_view THEN Find_SRID(nspname::varchar, t.name::varchar, c.column_name::varchar) ELSE NULL END AS srid
+    FROM
+        pg_namespace
+    LEFT JOIN
+    "table" AS t ON t.schema = nspname AND t.created_on IS NOT NULL
+    LEFT JOIN
+        information_schema.columns c on c.table_schema = nspname AND t.name = c.table_name
+    LEFT JOIN (
+        SELECT
+            tc.table_schema,
+            tc.table_name,
+            column_name,
+            tc.constraint_type
+        FROM
+            information_schema.table_constraints as tc
+        INNER JOIN
+            information_schema.key_column_usage as kcu
+        ON
+            tc.constraint_name = kcu.constraint_name
+            AND
+            tc.table_schema = kcu.table_schema
+            AND
+            tc.table_name = kcu.table_name
+        WHERE
+            tc.constraint_type = 'PRIMARY KEY'
+    ) pks ON pks.table_schema = nspname AND pks.table_name = t.name AND pks.column_name = c.column_name
+    WHERE
+        pg_namespace.nspowner != 10 AND
+        nspname != 'geometries' AND
+        nspname NOT IN(%s, %s)
+    ORDER BY
+        nspname, t.name, c.ordinal_position
+"""
+
+class Command(BaseCommand):
+    help = (
+        "Time the topology query against the legacy information_schema query, "
+        "as the number of tables grows. This creates throwaway schemas (%s*) "
+        "with %d tables each, and drops them when it is done. It has to be run "
+        "as a database user that isn't the superuser, since the topology leaves "
+        "out the superuser's schemas" % (SCHEMA_PREFIX, TABLES_PER_SCHEMA)
+    )
+
+    option_list = BaseCommand.option_list + (
+        make_option("--sizes", dest="sizes", default="10,100,1000,10000",
+            help="A comma separated list of the numbers of tables to time the queries with"),
+        make_option("--repeat", type="int", dest="repeat", default=3,
+            help="The number of times to run each query. The fastest time is reported"),
+        make_option("--skip-legacy", action="store_true", dest="skip_legacy", default=False,
+            help="Only time the new query (the legacy one takes a long time on big catalogs)"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = sorted(int(size) for size in options['sizes'].split(","))
+        except ValueError:
+            raise CommandError("--sizes has to be a list of numbers")
+
+        owner = User.objects.order_by("pk").first()
+        if owner is None:
+            raise CommandError("There has to be at least one user to own the tables")
+
+        self.stdout.write("%10s %10s %10s %14s" % ("tables", "rows", "catalog", "legacy"))
+        n_tables = 0
+        try:
+            for size in sizes:
+                while n_tables < size:
+                    self._createTable(n_tables, owner)
+                    n_tables += 1
+
+                catalog_seconds, n_rows = self._time(_queryTopologyRows, options['repeat'])
+                if options['skip_legacy']:
+                    legacy = "-"
+                else:
+                    legacy_seconds, _ = self._time(self._queryLegacy, options['repeat'])
+                    legacy = "%.3fs" % legacy_seconds
+                self.stdout.write("%10d %10d %9.3fs %14s" % (n_tables, n_rows, catalog_seconds, legacy))
+        finally:
+            self._cleanup()
+
+    def _createTable(self, i, owner):
+        schema = "%s%d" % (SCHEMA_PREFIX, i // TABLES_PER_SCHEMA)
+        name = "table%d" % (i % TABLES_PER_SCHEMA)
+        cursor = connection.cursor()
+        if i % TABLES_PER_SCHEMA == 0:
+            cursor.execute("CREATE SCHEMA %s" % schema)
+        cursor.execute("CREATE TABLE %s.%s (id serial PRIMARY KEY, label text, amount numeric)" % (schema, name))
+        cursor.execute("SELECT AddGeometryColumn(%s, %s, 'the_geom', 4326, 'MULTIPOLYGON', 2)", (schema, name))
+        # bulk_create skips TableOrView.save, so the cached topology isn't
+        # invalidated over and over again
+        TableOrView.objects.bulk_create([TableOrView(name=name, schema=schema, created_on=timezone.now(), owner=owner)])
+
+    def _time(self, query, repeat):
+        """Return the fastest time it took to run `query`, and the number of
+        rows it returned"""
+        best = None
+        for i in range(max(1, repeat)):
+            start = time.time()
+            rows = query()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, len(rows)
+
+    def _queryLegacy(self):
+        cursor = connection.cursor()
+        cursor.execute(LEGACY_TOPOLOGY_SQL, (AUDIT_SCHEMA_NAME, "drupal"))
+        return cursor.fetchall()
+
+    def _cleanup(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE %s", (SCHEMA_PREFIX.replace("_", "\\_") + "%",))
+        # drop them one at a time so there is never one transaction holding
+        # locks on thousands of tables
+        for schema, in cursor.fetchall():
+            cursor.execute("DROP SCHEMA %s CASCADE" % schema)
+        TableOrView.objects.filter(schema__startswith=SCHEMA_PREFIX).delete()
+        invalidateTopology()
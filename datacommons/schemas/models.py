@@ -1,7 +1,10 @@
-import itertools
+import cStringIO
+import psycopg2
+from psycopg2.extensions import register_adapter
 from django.utils.datastructures import SortedDict
 from django.conf import settings as SETTINGS
 from django.db import models, connection, transaction, DatabaseError, connections
+from datacommons.utils.stopwatch import Stopwatch
 
 AUDIT_SCHEMA_NAME = "_version"
 
@@ -33,6 +36,22 @@ class Schema(SchemataItem):
         # use the stored proc created by mharvey to setup the proper perms on the
         # table
         cursor.execute("SELECT dc_set_perms(%s);", (name,))
+        invalidateTopology()
+
+
+class TopologyGeneration(models.Model):
+    """
+    The one row in this table holds the generation of the topology, which the
+    cached topology is keyed on. It is incremented whenever the schemas,
+    tables, views or columns in the database change (see invalidateTopology),
+    in the same transaction as the change, so the generation only moves
+    forward once the change is committed. The UPDATE locks the row until
+    then, so the changes commit in the order of their generations
+    """
+    generation = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'topologygeneration'
 
 
 class TableOrView(models.Model):
@@ -55,6 +74,15 @@ class TableOrView(models.Model):
     def __unicode__(self):
         return u'%s' % (self.name)
 
+    def save(self, *args, **kwargs):
+        super(TableOrView, self).save(*args, **kwargs)
+        # the topology only includes tables that have been created
+        invalidateTopology()
+
+    def delete(self, *args, **kwargs):
+        super(TableOrView, self).delete(*args, **kwargs)
+        invalidateTopology()
+
 
 class View(SchemataItem, TableOrView):
     """This model represents a view in a schema"""
@@ -72,9 +100,10 @@ class View(SchemataItem, TableOrView):
 
     def create(self, sql):
         # this will raise a database Error is there is a problem with the SQL (hopefully)
-        SQLHandle(sql).count()
+        SQLHandle(sql).describe()
         cursor = connection.cursor()
         cursor.execute("SELECT dc_create_view(%s, %s, %s)", (self.schema, self.name, sql))
+        invalidateTopology()
 
     def delete(self):
         cursor = connection.cursor()
@@ -259,6 +288,7 @@ class Table(SchemataItem, TableOrView):
         # run morgan's fancy proc
         cursor.execute("SELECT dc_set_perms(%s, %s);", (schema_name, table_name))
         cursor.execute("SELECT dc_set_perms(%s, %s);", (AUDIT_SCHEMA_NAME, audit_table_name))
+        invalidateTopology()
 
     def _addGeometryColumn(self, schema_name, table_name, col):
         cursor = connection.cursor()
@@ -311,15 +341,10 @@ class ColumnTypes:
         GEOMETRY: "geometry",
     }
 
-    # maps a *cursor* type code to the enum value. You can get only get these numbers
-    # from the cursor.description of a query that includes a column of that
-    # particular type. This is necessarily complicated by the fact
-    # that PG type codes vary from database to database, so they have to be
-    # generated at runtime
-    FROM_PG_CURSOR_TYPE_CODE = dict([(
-        ((cur.execute("SELECT NULL::%s" % value) or True) and cur.description[0].type_code), key) 
-        for (key, value), cur in zip(TO_PG_TYPE.items(), itertools.repeat(connection.cursor()))
-    ])
+    # maps a *cursor* type code to the enum value. PG type codes vary from
+    # database to database, so they are looked up the first time they are
+    # needed (see dbhelpers.serverInfo)
+    _from_pg_cursor_type_code = None
 
     @classmethod
     def toString(cls, enum):
@@ -338,7 +363,10 @@ class ColumnTypes:
     @classmethod 
     def fromPGCursorTypeCode(cls, type_code):
         """Convert a cursor.description type_code to a type number"""
-        return cls.FROM_PG_CURSOR_TYPE_CODE.get(type_code, cls.CHAR)
+        if cls._from_pg_cursor_type_code is None:
+            type_codes = serverInfo()['type_codes']
+            cls._from_pg_cursor_type_code = dict((type_codes[value], key) for key, value in cls.TO_PG_TYPE.items())
+        return cls._from_pg_cursor_type_code.get(type_code, cls.CHAR)
 
     @classmethod 
     def fromPGTypeName(cls, type_code):
@@ -489,7 +517,7 @@ class Version(models.Model):
         """ % safe_params
         #cursor = connection.cursor()
         #cursor.execute(sql, params)
-        return SQLHandle(sql, params, privileged=True)
+        return SQLHandle(sql, params, privileged=True, keys=[pk.name for pk in pks])
 
 
 class TableMutator(object):
@@ -498,8 +526,10 @@ class TableMutator(object):
     has to be created dynamically. It also provides methods to perform
     mutations
     """
-    def __init__(self, version, columns=None):
+    def __init__(self, version, columns=None, stopwatch=None):
         self.table = version.table
+        # times the statements run on the table, and the audit table
+        self.stopwatch = stopwatch or Stopwatch()
 
         # the caller can pass in the columns, or we can fetch them ourselves
         if columns is None:
@@ -515,7 +545,7 @@ class TableMutator(object):
         escape_string = []
         for col in self.columns:
             if col.type == ColumnTypes.GEOMETRY:
-                escape_string.append("ST_Multi(ST_Transform(ST_GeomFromText(%%s, %s), %d))" % (col.srid, SETTINGS.OFFICIAL_SRID))
+                escape_string.append(_castSQL(col, "%s"))
             else:
                 escape_string.append("%s")
         escape_string = ",".join(escape_string)
@@ -550,23 +580,52 @@ class TableMutator(object):
             escape_string,
             int(version.pk)
         )
+
+        # and the SQL strings for deleting every row
+        self.audit_delete_all_sql = 'INSERT INTO "%s"."%s" (%s, _inserted_or_deleted, _version_id) SELECT %s, -1, %s FROM "%s"."%s"' % (
+            AUDIT_SCHEMA_NAME,
+            internalSanitize(self.table.auditTableName()),
+            safe_pk_name_str,
+            safe_pk_name_str,
+            int(version.pk),
+            sanitize(self.table.schema),
+            sanitize(self.table.name),
+        )
+        self.delete_all_sql = 'DELETE FROM "%s"."%s"' % (
+            sanitize(self.table.schema),
+            sanitize(self.table.name),
+        )
         self.cursor = connection.cursor()
 
     def insertRow(self, values):
         """Values is a tuple of values that corresponds to the order of self.columns"""
-        self._doSQL(self.insert_sql, values)
-        self._doSQL(self.audit_insert_sql, values)
+        with self.stopwatch.time("insert", rows=1):
+            self._doSQL(self.insert_sql, values)
+        with self.stopwatch.time("audit", rows=1):
+            self._doSQL(self.audit_insert_sql, values)
 
     def deleteRow(self, values):
         """Values is a tuple of pk values that corresponds to the order of self.columns"""
-        if self._doSQL(self.delete_sql, values) > 0:
-            self._doSQL(self.audit_delete_sql, values)
+        with self.stopwatch.time("delete") as counts:
+            counts['rows'] = self._doSQL(self.delete_sql, values)
+        if counts['rows'] > 0:
+            with self.stopwatch.time("audit", rows=counts['rows']):
+                self._doSQL(self.audit_delete_sql, values)
 
     def deleteAllRows(self):
-        pks = [col.name for col in self.columns if col.is_pk]
-        handle = fetchRowsFor(self.table.schema, self.table.name, pks)
-        for row in handle:
-            self.deleteRow(row)
+        """Delete every row in the table. This has the same effect on the
+        audit table as calling deleteRow on each row, but is done with one
+        INSERT ... SELECT and one DELETE. Returns the number of rows deleted.
+        Raises ValueError if the table has no primary key, since the deleted
+        rows are recorded in the audit table by their primary key"""
+        if not any(col.is_pk for col in self.columns):
+            raise ValueError("All the rows in %s.%s can't be deleted, because it has no primary key" % (self.table.schema, self.table.name))
+
+        with self.stopwatch.time("audit") as counts:
+            counts['rows'] = self._doSQL(self.audit_delete_all_sql, ())
+        with self.stopwatch.time("delete") as counts:
+            counts['rows'] = self._doSQL(self.delete_all_sql, ())
+        return counts['rows']
 
     def _doSQL(self, sql, params):
         cursor = self.cursor
@@ -580,4 +639,204 @@ class TableMutator(object):
 
         return cursor.rowcount
 
-from datacommons.utils.dbhelpers import sanitize, SQLHandle, getDatabaseTopology, internalSanitize, getPrimaryKeysForTable, getColumnsForTable, fetchRowsFor
+
+class TableLoader(object):
+    """
+    This loads rows into a table, and its audit table, in batches using COPY
+    instead of issuing an INSERT per row (like TableMutator does). Each batch
+    is copied into a temporary staging table with text columns, and then moved
+    into the real tables with INSERT ... SELECT, so the values (including
+    geometries) are converted to the right types on the way in
+    """
+    BATCH_SIZE = 5000
+
+    def __init__(self, version, columns=None, stopwatch=None):
+        self.table = version.table
+        # times the statements run on the table, and the audit table
+        self.stopwatch = stopwatch or Stopwatch()
+
+        # the caller can pass in the columns, or we can fetch them ourselves
+        if columns is None:
+            self.columns = getColumnsForTable(self.table.schema, self.table.name)
+        else:
+            self.columns = columns
+
+        self.staging_table = "_staging_%d" % int(version.pk)
+        safe_col_names = ['"%s"' % sanitize(col.name) for col in self.columns]
+        safe_col_name_str = ",".join(safe_col_names)
+        # convert the text in the staging table to the type of each column
+        select_str = ",".join(_castSQL(col, name) for col, name in zip(self.columns, safe_col_names))
+
+        self.copy_sql = 'COPY pg_temp."%s" (%s) FROM STDIN' % (self.staging_table, safe_col_name_str)
+        self.insert_sql = 'INSERT INTO "%s"."%s" (%s) SELECT %s FROM pg_temp."%s"' % (
+            sanitize(self.table.schema),
+            sanitize(self.table.name),
+            safe_col_name_str,
+            select_str,
+            self.staging_table,
+        )
+        self.audit_insert_sql = 'INSERT INTO "%s"."%s" (%s, _inserted_or_deleted, _version_id) SELECT %s, 1, %d FROM pg_temp."%s"' % (
+            AUDIT_SCHEMA_NAME,
+            internalSanitize(self.table.auditTableName()),
+            safe_col_name_str,
+            select_str,
+            int(version.pk),
+            self.staging_table,
+        )
+
+        # build the SQL strings for deleting the rows in the table that match
+        # the primary keys of the rows in the staging table
+        match_str = " AND ".join('t.%s = %s' % (name, _castSQL(col, "s." + name)) for col, name in zip(self.columns, safe_col_names) if col.is_pk)
+        safe_pk_names = ['"%s"' % sanitize(col.name) for col in self.columns if col.is_pk]
+        self.audit_delete_sql = 'INSERT INTO "%s"."%s" (%s, _inserted_or_deleted, _version_id) SELECT %s, -1, %d FROM "%s"."%s" t WHERE EXISTS (SELECT 1 FROM pg_temp."%s" s WHERE %s)' % (
+            AUDIT_SCHEMA_NAME,
+            internalSanitize(self.table.auditTableName()),
+            ",".join(safe_pk_names),
+            ",".join("t." + name for name in safe_pk_names),
+            int(version.pk),
+            sanitize(self.table.schema),
+            sanitize(self.table.name),
+            self.staging_table,
+            match_str,
+        )
+        self.delete_sql = 'DELETE FROM "%s"."%s" t USING pg_temp."%s" s WHERE %s' % (
+            sanitize(self.table.schema),
+            sanitize(self.table.name),
+            self.staging_table,
+            match_str,
+        )
+        # keep only the last staged row with each primary key, which is what
+        # inserting the rows one at a time would end up with. This is a
+        # semi-join, so it can be planned as a hash join on the primary key
+        # however many rows are staged
+        later_str = " AND ".join('%s = %s' % (_castSQL(col, "later." + name), _castSQL(col, "s." + name)) for col, name in zip(self.columns, safe_col_names) if col.is_pk)
+        self.dedupe_sql = 'DELETE FROM pg_temp."%s" s WHERE EXISTS (SELECT 1 FROM pg_temp."%s" later WHERE %s AND later._staging_row > s._staging_row)' % (
+            self.staging_table,
+            self.staging_table,
+            later_str,
+        )
+
+        self.cursor = connection.cursor()
+        self.cursor.execute('DROP TABLE IF EXISTS pg_temp."%s"' % self.staging_table)
+        # _staging_row numbers the rows in the order they were staged
+        self.cursor.execute('CREATE TEMPORARY TABLE "%s" (_staging_row serial, %s)' % (
+            self.staging_table,
+            ",".join(name + " text" for name in safe_col_names)
+        ))
+
+    def batches(self, rows):
+        """Split an iterable of rows into lists of at most BATCH_SIZE rows"""
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def insertRows(self, rows):
+        """Rows is a list of tuples of values that correspond to the order of
+        self.columns"""
+        self.stageRows(rows)
+        self.insertStagedRows()
+        self.clearStagedRows()
+
+    def insertStagedRows(self):
+        """Insert every row in the staging table into the table"""
+        with self.stopwatch.time("insert") as counts:
+            counts['rows'] = self._doSQL(self.insert_sql)
+        with self.stopwatch.time("audit") as counts:
+            counts['rows'] = self._doSQL(self.audit_insert_sql)
+
+    def dedupeStagedRows(self):
+        """Remove every row from the staging table that has the same primary
+        key as a row staged after it, so the last one wins. Returns the number
+        of rows removed"""
+        if not any(col.is_pk for col in self.columns):
+            return 0
+        with self.stopwatch.time("dedupe") as counts:
+            counts['rows'] = self._doSQL(self.dedupe_sql)
+        return counts['rows']
+
+    def deleteStagedRows(self):
+        """Delete every row in the table with the same primary key as a row in
+        the staging table. Returns the number of rows deleted"""
+        with self.stopwatch.time("audit") as counts:
+            counts['rows'] = self._doSQL(self.audit_delete_sql)
+        with self.stopwatch.time("delete") as counts:
+            counts['rows'] = self._doSQL(self.delete_sql)
+        return counts['rows']
+
+    def clearStagedRows(self):
+        self._doSQL('TRUNCATE pg_temp."%s"' % self.staging_table)
+
+    def analyzeStagedRows(self):
+        """Temporary tables are never analyzed by autovacuum, so this needs to
+        be done after staging a lot of rows, or the planner will pick a
+        terrible plan when joining on the staging table"""
+        self._doSQL('ANALYZE pg_temp."%s"' % self.staging_table)
+
+    def stageRows(self, rows):
+        """COPY the rows into the staging table"""
+        buf = cStringIO.StringIO()
+        for row in rows:
+            buf.write("\t".join(_copyValue(value) for value in row))
+            buf.write("\n")
+        buf.seek(0)
+        try:
+            with self.stopwatch.time("stage", rows=len(rows), bytes=len(buf.getvalue())):
+                with transaction.atomic():
+                    self.cursor.copy_expert(self.copy_sql, buf)
+        except DatabaseError as e:
+            e.sql = self.copy_sql
+            raise
+
+    def close(self):
+        """Drop the staging table"""
+        self.cursor.execute('DROP TABLE IF EXISTS pg_temp."%s"' % self.staging_table)
+
+    def _doSQL(self, sql, params=()):
+        cursor = self.cursor
+        try:
+            with transaction.atomic():
+                cursor.execute(sql, params)
+        except DatabaseError as e:
+            # tack on the SQL statement that caused the error
+            e.sql = sql
+            raise
+
+        return cursor.rowcount
+
+
+def _castSQL(col, sql):
+    """Return the SQL that converts the expression `sql` to the type of the
+    column. Geometries can be WKT, hex encoded WKB, or WKB in a bytea"""
+    if col.type == ColumnTypes.GEOMETRY:
+        return "ST_Multi(ST_Transform(ST_SetSRID(%s::geometry, %d), %d))" % (sql, int(col.srid), SETTINGS.OFFICIAL_SRID)
+    return "%s::%s" % (sql, ColumnTypes.toPGType(col.type))
+
+def _copyValue(value):
+    """Format a value for the text format of COPY"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, WKB):
+        # the geometry type accepts hex encoded WKB as text input
+        return value.encode("hex")
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif isinstance(value, float):
+        # repr doesn't lose precision like str does
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+class WKB(str):
+    """A geometry in the Well-Known Binary format. Unlike WKT, this doesn't
+    have to be formatted and parsed again to get it into a table. It is sent
+    to postgres as a bytea, or as hex in a COPY"""
+
+register_adapter(WKB, lambda value: psycopg2.Binary(str(value)))
+
+from datacommons.utils.dbhelpers import sanitize, SQLHandle, getDatabaseTopology, internalSanitize, getPrimaryKeysForTable, getColumnsForTable, invalidateTopology, serverInfo
@@ -10,23 +10,75 @@ from django.db import DatabaseError
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from datacommons.utils.dbhelpers import (
     fetchRowsFor,
-    getDatabaseTopology
+    getColumnsForTable,
+    SQLPaginator
 )
 from datacommons.accounts.models import User
+from datacommons.jsonencoder import JSONEncoder
 from datacommons.api.models import DownloadLog
 from .models import ColumnTypes, Table, TablePermission, Version, TableOrView, View
 from .forms import PermissionsForm, TablePermissionsForm, CreateSchemaForm, DeleteViewForm
 
+# the number of schemas or tables in a page of the catalog
+CATALOG_PAGE_SIZE = 100
+
+# the number of rows on a page of a table
+ROWS_PAGE_SIZE = 100
+
 @login_required
 def tables(request):
-    """Display a nested list of all the schemas and tables in the database"""
-    schemas = getDatabaseTopology(owner=request.user)
-    schemas = filter(lambda schema: len(list(schema)) > 0, schemas)
+    """Display a nested list of all the schemas and tables in the database.
+    The list is loaded from the catalog views as the schemas are opened"""
+    return render(request, "schemas/list.html", {})
+
+@login_required
+def catalogSchemas(request):
+    """Return a page of the names of the schemas that have tables or views in
+    them, as JSON"""
+    names = TableOrView.objects.filter(created_on__isnull=False).order_by("schema").values_list("schema", flat=True).distinct()
+    return _catalogPage(request, names, lambda name: {"name": name})
 
-    return render(request, "schemas/list.html", {
-        "schemas": schemas,
+@login_required
+def catalogTables(request, schema_name):
+    """Return a page of the tables and views in a schema, as JSON. If the
+    `views` parameter is "own", only the views owned by the user are
+    included"""
+    tables = TableOrView.objects.filter(schema=schema_name, created_on__isnull=False)
+    if request.GET.get("views") == "own":
+        tables = tables.filter(Q(is_view=False) | Q(owner_id=request.user.pk))
+
+    return _catalogPage(request, tables, lambda table: {
+        "name": table.name,
+        "is_view": table.is_view,
+        "owner_id": table.owner_id,
     })
 
+@login_required
+def catalogColumns(request, schema_name, table_name):
+    """Return the columns of a table or view, as JSON"""
+    get_object_or_404(TableOrView, schema=schema_name, name=table_name, created_on__isnull=False)
+    return HttpResponse(json.dumps({
+        "columns": getColumnsForTable(schema_name, table_name),
+    }, cls=JSONEncoder), content_type="application/json")
+
+def _catalogPage(request, items, toJSON):
+    """Return the page of `items` in the page GET parameter as a JSON
+    response"""
+    paginator = Paginator(items, CATALOG_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get("page"))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+
+    return HttpResponse(json.dumps({
+        "results": [toJSON(item) for item in page],
+        "page": page.number,
+        "num_pages": paginator.num_pages,
+        "has_next": page.has_next(),
+    }, cls=JSONEncoder), content_type="application/json")
+
 @login_required
 def show(request, schema_name, table_name):
     """View the table in schema, including the column names and types"""
@@ -44,14 +96,23 @@ def show(request, schema_name, table_name):
 
     versions = list(Version.objects.filter(table=table))
 
-    paginator = Paginator(pageable, 100)
-    page = request.GET.get("page")
-    try:
-        rows = paginator.page(page)
-    except PageNotAnInteger:
-        rows = paginator.page(1)
-    except EmptyPage:
-        rows = paginator.page(paginator.num_pages)
+    # tables with a primary key are paged through by it, so deep pages are as
+    # fast as the first one. The numbered pages still work too
+    keyset = pageable.has_keys and "page" not in request.GET
+    if keyset:
+        try:
+            rows = pageable.keysetPage(ROWS_PAGE_SIZE, after=request.GET.get("after"), before=request.GET.get("before"))
+        except ValueError:
+            rows = pageable.keysetPage(ROWS_PAGE_SIZE)
+    else:
+        paginator = SQLPaginator(pageable, ROWS_PAGE_SIZE)
+        page = request.GET.get("page")
+        try:
+            rows = paginator.page(page)
+        except PageNotAnInteger:
+            rows = paginator.page(1)
+        except EmptyPage:
+            rows = paginator.page(paginator.num_pages)
 
     show_restore_link = version and version.pk != versions[-1].pk and version.table.canRestore(request.user)
 
@@ -64,6 +125,7 @@ def show(request, schema_name, table_name):
 
     return render(request, "schemas/show.html", {
         "rows": rows,
+        "keyset": keyset,
         "cols": pageable.cols,
         "has_geom": next((col for col in pageable.cols if col.type == ColumnTypes.GEOMETRY), False),
         "table": table,
@@ -1,2 +1,6 @@
 from base import *
 from local import *
+
+# imports record their progress on a separate connection, so it can be seen
+# while the import's transaction is still open
+DATABASES.setdefault('progress', dict(DATABASES['default']))
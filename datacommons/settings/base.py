@@ -16,6 +16,10 @@ OFFICIAL_PRJ = 'GEOGCS["WGS 84", DATUM["WGS_1984", SPHEROID["WGS 84",6378137,298
 
 SERVER_EMAIL = 'django@pdx.edu'
 
+# when True, imports are queued and run by the runimports management command
+# instead of during the request
+BACKGROUND_IMPORTS = True
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -43,6 +47,38 @@ USE_TZ = True
 # Example: "/home/media/media.lawrence.com/media/"
 MEDIA_ROOT = os.path.join(HOME_DIR, "htdocs", "media")
 
+# Absolute path to the directory that things that are expensive to compute are
+# cached in. It must be writable by the web server, and shouldn't be served.
+CACHE_ROOT = os.path.join(HOME_DIR, "cache")
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # the topology of the database (see dbhelpers.getDatabaseTopology), which
+    # is shared by every process
+    'topology': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_ROOT, "topology"),
+        'TIMEOUT': 60 * 60 * 24,
+    },
+    # the reserved words and type codes of the database server (see
+    # dbhelpers.serverInfo), keyed by the server version. Switch it to the
+    # DummyCache to always look them up
+    'server': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_ROOT, "server"),
+        'TIMEOUT': 60 * 60 * 24 * 30,
+    },
+    # the exact number of rows in tables, keyed by their latest version (see
+    # dbhelpers.SQLHandle.count)
+    'counts': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(CACHE_ROOT, "counts"),
+        'TIMEOUT': 60 * 60 * 24 * 7,
+    },
+}
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
 # Examples: "http://media.lawrence.com/media/", "http://example.com/media/"
@@ -0,0 +1,305 @@
+"""
+This figures out the EPSG code of the projection in a shapefile's .prj file,
+without asking a web service.
+
+The .prj is parsed, and boiled down to a fingerprint of the things that
+actually define the projection (the ellipsoid, prime meridian, projection,
+parameters and units), so the ESRI flavor of WKT, which names everything
+differently, still matches. The fingerprints are looked up in an index of the
+EPSG definitions that come with PostGIS (in the spatial_ref_sys table). When
+more than one definition matches, the one with the same datum name wins.
+
+Resolved .prj files are cached in memory, and on disk in CACHE_ROOT, keyed by
+the SHA-1 of the .prj contents.
+"""
+import os
+import re
+import json
+import hashlib
+import tempfile
+from django.conf import settings as SETTINGS
+from django.db import connection
+from datacommons.utils.lru import LRUCache
+
+# the projections ESRI has names for, that aren't in the EPSG database
+WELL_KNOWN_PROJECTIONS = {
+    "mercatorauxiliarysphere": 3857,
+}
+
+# the ESRI names of projections and parameters, and the EPSG name they match
+NAME_ALIASES = {
+    "albers": "albersconicequalarea",
+    "longitudeofcenter": "centralmeridian",
+    "latitudeofcenter": "latitudeoforigin",
+}
+
+# parameters that are left out of the fingerprint when they have these
+# values, since they mean the same thing as not being there at all
+DEFAULT_PARAMETERS = {
+    "scalefactor": 1.0,
+}
+
+_TOKEN_RE = re.compile(r'\s*(?:"((?:[^"]|"")*)"|([\[\](),])|([^\s\[\](),"]+))')
+
+def parseWKT(text):
+    """Parse WKT into nested 2-tuples of (KEYWORD, [arguments]). Arguments are
+    strings, floats, or more 2-tuples. Raises ValueError if the WKT is
+    malformed"""
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None:
+            raise ValueError("Invalid WKT near: %s" % text[pos:pos+20])
+        pos = match.end()
+        quoted, punctuation, word = match.groups()
+        if quoted is not None:
+            tokens.append(("string", quoted.replace('""', '"')))
+        elif punctuation is not None:
+            tokens.append(("punctuation", punctuation))
+        else:
+            tokens.append(("word", word))
+
+    node, i = _parseNode(tokens, 0)
+    if i != len(tokens):
+        raise ValueError("Unexpected text after the end of the WKT")
+    return node
+
+def _parseNode(tokens, i):
+    try:
+        kind, keyword = tokens[i]
+        if kind != "word" or tokens[i+1] not in [("punctuation", "["), ("punctuation", "(")]:
+            raise ValueError("Expected a keyword followed by a bracket")
+        i += 2
+        args = []
+        while True:
+            kind, value = tokens[i]
+            if kind == "string":
+                args.append(value)
+                i += 1
+            elif kind == "word" and tokens[i+1] in [("punctuation", "["), ("punctuation", "(")]:
+                arg, i = _parseNode(tokens, i)
+                args.append(arg)
+            elif kind == "word":
+                try:
+                    args.append(float(value))
+                except ValueError:
+                    # an enum value, like NORTH in an AXIS
+                    args.append(value)
+                i += 1
+            else:
+                raise ValueError("Unexpected '%s'" % value)
+
+            kind, value = tokens[i]
+            i += 1
+            if value in ["]", ")"]:
+                return (keyword.upper(), args), i
+            if value != ",":
+                raise ValueError("Expected a comma")
+    except IndexError:
+        raise ValueError("The WKT ended unexpectedly")
+
+def fingerprint(node):
+    """Return a string that identifies the coordinate system described by
+    `node` (from parseWKT), regardless of the names used in it"""
+    return json.dumps(_fingerprint(node))
+
+def _fingerprint(node):
+    keyword, args = node
+    if keyword == "PROJCS":
+        projection = _normalizeName(_child(node, "PROJECTION")[1][0])
+        parameters = {}
+        for parameter in _children(node, "PARAMETER"):
+            name, value = _normalizeName(parameter[1][0]), _roundNumber(parameter[1][1])
+            if value != DEFAULT_PARAMETERS.get(name, 0):
+                parameters[name] = value
+        # the standard parallels can be listed in either order
+        if "standardparallel1" in parameters and "standardparallel2" in parameters:
+            parameters["standardparallel1"], parameters["standardparallel2"] = sorted([parameters["standardparallel1"], parameters["standardparallel2"]])
+        return [
+            "PROJCS",
+            _fingerprint(_child(node, "GEOGCS")),
+            projection,
+            sorted(parameters.items()),
+            _unit(node),
+        ]
+    elif keyword == "GEOGCS":
+        spheroid = _child(_child(node, "DATUM"), "SPHEROID")
+        primem = _child(node, "PRIMEM")
+        return [
+            "GEOGCS",
+            _roundNumber(spheroid[1][1]),
+            _roundNumber(spheroid[1][2]),
+            _roundNumber(primem[1][1]) if primem else 0.0,
+            _unit(node),
+        ]
+    raise ValueError("Not a supported coordinate system: %s" % keyword)
+
+def datumName(node):
+    """Return the normalized name of the datum of the coordinate system in
+    `node`"""
+    if node[0] == "PROJCS":
+        node = _child(node, "GEOGCS")
+    name = _child(node, "DATUM")[1][0]
+    # ESRI names are like D_North_American_1983, and EPSG names are like
+    # North_American_Datum_1983
+    if name.startswith("D_"):
+        name = name[2:]
+    return _normalizeName(name).replace("datum", "")
+
+def authorityCode(node):
+    """Return the EPSG code in the AUTHORITY of `node`, or None"""
+    authority = _child(node, "AUTHORITY")
+    if authority and str(authority[1][0]).upper() == "EPSG":
+        try:
+            return int(authority[1][1])
+        except (TypeError, ValueError):
+            return None
+    return None
+
+def _child(node, keyword):
+    for arg in node[1]:
+        if isinstance(arg, tuple) and arg[0] == keyword:
+            return arg
+    return None
+
+def _children(node, keyword):
+    return [arg for arg in node[1] if isinstance(arg, tuple) and arg[0] == keyword]
+
+def _unit(node):
+    unit = _child(node, "UNIT")
+    return _roundNumber(unit[1][1]) if unit else None
+
+def _normalizeName(name):
+    name = re.sub(r"[^a-z0-9]", "", str(name).lower())
+    # the 1SP and 2SP variants only differ by their parameters
+    name = re.sub(r"[12]sp$", "", name)
+    return NAME_ALIASES.get(name, name)
+
+def _roundNumber(value):
+    # different sources write out numbers with different precision
+    return float("%.9g" % float(value))
+
+
+class EPSGIndex(object):
+    """
+    This maps the fingerprints of the EPSG coordinate systems in
+    spatial_ref_sys to their codes. Building it means parsing thousands of WKT
+    strings, so it is saved to CACHE_ROOT and rebuilt only when
+    spatial_ref_sys changes
+    """
+    def __init__(self, signature, fingerprints):
+        self.signature = signature
+        # fingerprint -> list of [srid, datum name]
+        self.fingerprints = fingerprints
+
+    @classmethod
+    def load(cls):
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*), MAX(srid) FROM spatial_ref_sys WHERE auth_name = 'EPSG'")
+        signature = list(cursor.fetchone())
+
+        path = os.path.join(SETTINGS.CACHE_ROOT, "epsg_index.json")
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached['signature'] == signature:
+                return cls(signature, cached['fingerprints'])
+        except (IOError, ValueError, KeyError):
+            pass
+
+        index = cls.build(signature)
+        _writeCacheFile(path, json.dumps({"signature": signature, "fingerprints": index.fingerprints}))
+        return index
+
+    @classmethod
+    def build(cls, signature):
+        cursor = connection.cursor()
+        cursor.execute("SELECT auth_srid, srtext FROM spatial_ref_sys WHERE auth_name = 'EPSG' AND srtext != '' ORDER BY auth_srid")
+        fingerprints = {}
+        for srid, srtext in cursor.fetchall():
+            try:
+                node = parseWKT(srtext)
+                key = fingerprint(node)
+                datum = datumName(node)
+            except (ValueError, TypeError, IndexError):
+                # GEOCCS, COMPD_CS and so on can't be in a .prj
+                continue
+            fingerprints.setdefault(key, []).append([srid, datum])
+        return cls(signature, fingerprints)
+
+    def lookup(self, node):
+        """Return the EPSG code that matches the coordinate system in `node`,
+        or None"""
+        candidates = self.fingerprints.get(fingerprint(node), [])
+        if not candidates:
+            return None
+        datum = datumName(node)
+        for srid, candidate_datum in candidates:
+            if candidate_datum == datum:
+                return srid
+        # they are in order of srid, so this is the lowest code
+        return candidates[0][0]
+
+
+_index = None
+_cache = LRUCache(256)
+
+def resolveSRID(prj_text):
+    """Return the EPSG code of the projection in the contents of a .prj file,
+    or None if it can't be figured out"""
+    key = hashlib.sha1(prj_text).hexdigest()
+    if key in _cache:
+        return _cache[key]
+
+    path = os.path.join(SETTINGS.CACHE_ROOT, "prj", key + ".json")
+    try:
+        with open(path) as f:
+            srid = json.load(f)
+    except (IOError, ValueError):
+        srid = _resolve(prj_text)
+        _writeCacheFile(path, json.dumps(srid))
+
+    _cache[key] = srid
+    return srid
+
+def _resolve(prj_text):
+    global _index
+    try:
+        node = parseWKT(prj_text)
+    except ValueError:
+        return None
+
+    srid = authorityCode(node)
+    if srid is not None:
+        return srid
+
+    if node[0] == "PROJCS":
+        projection = _child(node, "PROJECTION")
+        if projection:
+            srid = WELL_KNOWN_PROJECTIONS.get(_normalizeName(projection[1][0]))
+            if srid is not None:
+                return srid
+
+    if _index is None:
+        _index = EPSGIndex.load()
+    try:
+        return _index.lookup(node)
+    except (ValueError, TypeError, IndexError):
+        return None
+
+def _writeCacheFile(path, contents):
+    """Write a file in the cache dir, in a way that never leaves a partially
+    written file behind"""
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # caching is just an optimization
+        pass
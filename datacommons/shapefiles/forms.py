@@ -16,6 +16,12 @@ class ShapefilePreviewForm(ImportablePreviewForm):
 
     def __init__(self, *args, **kwargs):
         super(ShapefilePreviewForm, self).__init__(*args, **kwargs)
+        # preselect the projection in the .prj file
+        srid = self.model.srid()
+        if srid is not None:
+            if srid not in [choice for choice, label in self.fields['srid'].choices]:
+                self.fields['srid'].choices = [(srid, "%d - From the .prj file" % srid)] + list(self.fields['srid'].choices)
+            self.fields['srid'].initial = srid
         if self.model.mode == ImportableUpload.CREATE:
             # find the geom column and make it uneditable
             last_field_index = 0
@@ -1,5 +1,3 @@
-import json
-import requests
 from itertools import izip
 import os
 import zipfile
@@ -7,11 +5,14 @@ import shapefile
 import fnmatch
 from django.forms import ValidationError
 from django.conf import settings as SETTINGS
-from shapely.geometry import asShape
+import shapely.wkb
 from django.db import models 
 from datacommons.schemas.models import ColumnTypes
 from datacommons.utils.dbhelpers import sanitize, inferColumnTypes
 from datacommons.importable.models import ImportableUpload
+from .epsg import resolveSRID
+from .wkb import shapeToWKB
+from .ziparchive import ShapefileArchive
 
 # Create your models here.
 class ShapefileImport(ImportableUpload):
@@ -22,64 +23,104 @@ class ShapefileImport(ImportableUpload):
     class Meta:
         proxy = True
 
+    # the members of the zip file that make up the shapefile
+    REQUIRED_FILES = ["*.shp", "*.shx", "*.dbf", "*.prj"]
+    # the members the shapefile.Reader reads
+    READER_FILES = ["*.shp", "*.shx", "*.dbf"]
+
     @classmethod
     def upload(cls, f):
         importable = super(ShapefileImport, cls).upload(f)
-        # extra the zip
-        z = zipfile.ZipFile(importable.path, 'r')
-        is_safe_path = lambda x: os.path.abspath(x).startswith(os.path.abspath("."))
-        # make sure the zipfile entry names aren't hackable
-        for entry in z.infolist():
-            if not is_safe_path(entry.filename):
-                raise ValueError("Security violation") 
-
         # make sure all the required files exist
-        required_files = {
-            "*.shp": None, 
-            "*.shx": None, 
-            "*.dbf": None, 
-            "*.prj": None,
-        }
-        # don't be hating on my O(n*m) algorithm
-        for entry in z.infolist():
-            for file_ext_glob in required_files:
-                if fnmatch.fnmatch(entry.filename, file_ext_glob):
-                    required_files[file_ext_glob] = entry.filename
-
-        missing_files = set(k for k, v in required_files.items() if v is None)
+        with importable.stopwatch.time("upload"):
+            members = importable._members()
+        missing_files = set(k for k in cls.REQUIRED_FILES if k not in members)
         if missing_files:
             raise ValidationError("Missing some files: %s" % (", ".join(missing_files)))
-        # extract the zip
-        # the last part of the path is a guid (except for the .ext part, which we trim off)
-        guid = os.path.split(importable.path)[1].split(".")[0]
-        extract_to = os.path.join(SETTINGS.MEDIA_ROOT, guid)
-        z.extractall(extract_to)
-        z.close()
-
-        # move the required files
-        for file_ext_glob, path in required_files.items():
-            ext = file_ext_glob.replace("*", "")
-            new_path = os.path.normpath(os.path.join(SETTINGS.MEDIA_ROOT, guid + ext))
-            old_path = os.path.normpath(os.path.join(SETTINGS.MEDIA_ROOT, guid, path))
-            os.rename(old_path, new_path)
-
-        # change the path of the importabled object to the .shp file
-        importable.filename = guid + '.shp'
+
+        # compressed members are decompressed once, here, instead of every
+        # time the upload is read
+        with importable.stopwatch.time("upload"):
+            archive = ShapefileArchive(importable.path)
+            try:
+                for file_ext_glob in cls.READER_FILES:
+                    if not archive.isStored(members[file_ext_glob]):
+                        archive.extract(members[file_ext_glob], importable._extractedPath(file_ext_glob))
+            finally:
+                archive.close()
 
         return importable
 
+    def _members(self):
+        """Return a dict of the glob of each required file (like "*.shp") to
+        the name of the member in the zip file that matches it"""
+        members = {}
+        with zipfile.ZipFile(self.path, 'r') as z:
+            for entry in z.infolist():
+                # skip the resource forks OS X adds to zip files
+                if entry.filename.startswith("__MACOSX/"):
+                    continue
+                for file_ext_glob in self.REQUIRED_FILES:
+                    if fnmatch.fnmatch(entry.filename.lower(), file_ext_glob):
+                        members[file_ext_glob] = entry.filename
+        return members
+
+    def _extractedPath(self, file_ext_glob):
+        """Return the full path a compressed member of the zip file (like
+        "*.shp") is decompressed to"""
+        return self.path + file_ext_glob[1:]
+
+    def _isExtracted(self):
+        """Older uploads were extracted from the zip file, and the path points
+        to the .shp file"""
+        return self.filename.endswith(".shp")
+
+    def reader(self):
+        """Return the shapefile.Reader for the shapefile. The files are read
+        straight out of the uploaded zip file (or the decompressed copies made
+        by upload()), and the reader is shared by everything that reads this
+        upload until closeReader() is called"""
+        if not hasattr(self, "_reader"):
+            if self._isExtracted():
+                self._reader = shapefile.Reader(self.path)
+            else:
+                self._archive = ShapefileArchive(self.path)
+                members = self._members()
+                self._reader = shapefile.Reader(
+                    shp=self._archive.open(members["*.shp"], self._extractedPath("*.shp")),
+                    shx=self._archive.open(members["*.shx"], self._extractedPath("*.shx")),
+                    dbf=self._archive.open(members["*.dbf"], self._extractedPath("*.dbf")),
+                )
+        return self._reader
+
+    def closeReader(self):
+        """Close the files opened by reader()"""
+        if hasattr(self, "_reader"):
+            for f in [self._reader.shp, self._reader.shx, self._reader.dbf]:
+                if f is not None:
+                    f.close()
+            del self._reader
+        if hasattr(self, "_archive"):
+            self._archive.close()
+            del self._archive
+
     def srid(self):
-        prj_path = self.path.replace(".shp", ".prj")
-        prj_file = open(prj_path, 'r')
-        prj_text = prj_file.read()
+        """Return the EPSG code of the shapefile's projection, or None if it
+        can't be figured out"""
+        if self._isExtracted():
+            with open(self.path.replace(".shp", ".prj"), 'r') as prj_file:
+                prj_text = prj_file.read()
+        else:
+            with zipfile.ZipFile(self.path, 'r') as z:
+                prj_text = z.read(self._members()["*.prj"])
 
-        response = requests.get("http://prj2epsg.org/search.json", params={"terms": prj_text})
-        results = json.loads(response.text)
-        return int(results['codes'][0]['code'])
+        return resolveSRID(prj_text)
 
     def geometryType(self):
-        shp = shapefile.Reader(self.path)
-        shp = shp.shape(0)
+        try:
+            shp = self.reader().shape(0)
+        finally:
+            self.closeReader()
         if shp.shapeType in [shapefile.POINT, shapefile.POINTM, shapefile.POINTZ, shapefile.MULTIPOINT, shapefile.MULTIPOINTM, shapefile.MULTIPOINTZ]:
             return 'MULTIPOINT'
         elif shp.shapeType in [shapefile.POLYLINE, shapefile.POLYLINEM, shapefile.POLYLINEZ]:
@@ -87,9 +128,9 @@ class ShapefileImport(ImportableUpload):
         elif shp.shapeType in [shapefile.POLYGON, shapefile.POLYGONM, shapefile.POLYGONZ]:
             return 'MULTIPOLYGON'
 
-    def parse(self):
-        """Parse a shapefile and return the header row, some of the data rows and
-        inferred data types"""
+    def parseFile(self):
+        """Parse a shapefile and return the header row, some of the data rows,
+        inferred data types and the number of data rows"""
         rows = []
         max_rows = 10
         # read in the first few rows, and save to a buffer.
@@ -98,7 +139,7 @@ class ShapefileImport(ImportableUpload):
         try:
             for i, row in enumerate(self):
                 if i < max_rows:
-                    rows.append(row)
+                    rows.append(self._displayRow(row))
                 else:
                     break
         except shapefile.ShapefileException as e:
@@ -107,18 +148,38 @@ class ShapefileImport(ImportableUpload):
             # Python3's `raise SomeException from other_exception` would be nice here
             raise shapefile.ShapefileException("Could not parse shapefile")
 
-        shp = shapefile.Reader(self.path)
-        header = [sanitize(field[0]) for field in shp.fields[1:]]
+        try:
+            shp = self.reader()
+            header = [sanitize(field[0]) for field in shp.fields[1:]]
+            row_count = shp.numRecords
+        finally:
+            self.closeReader()
         header.append("the_geom")
         data = rows
-        types = inferColumnTypes(data)
+        with self.stopwatch.time("inference", rows=len(data)):
+            types = inferColumnTypes(data)
         if types[-1] != ColumnTypes.GEOMETRY:
             raise ValidationError("The geometry in the shapefile is invalid") 
-        return header, data, types
+        return header, data, types, row_count
+
+    def readRows(self, start, stop):
+        return [self._displayRow(row) for row in super(ShapefileImport, self).readRows(start, stop)]
+
+    def _displayRow(self, row):
+        """Convert the WKB geometry at the end of a row to WKT, so it can be
+        shown to a human"""
+        if row[-1] is not None:
+            row[-1] = shapely.wkb.loads(str(row[-1])).wkt
+        return row
 
     def __iter__(self):
-        shp = shapefile.Reader(self.path)
-        for row, shape in izip(shp.iterRecords(), shp.iterShapes()):
-            row.append(asShape(shape).wkt)
-            yield row
+        """Iterate over the rows, with the geometry as WKB at the end of each
+        row"""
+        shp = self.reader()
+        try:
+            for row, shape in izip(shp.iterRecords(), shp.iterShapes()):
+                row.append(shapeToWKB(shape))
+                yield row
+        finally:
+            self.closeReader()
 
@@ -0,0 +1,85 @@
+import struct
+import itertools
+import shapefile
+from datacommons.schemas.models import WKB
+
+# WKB geometry type codes
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+WKB_MULTIPOINT = 4
+WKB_MULTILINESTRING = 5
+WKB_MULTIPOLYGON = 6
+
+POINT_TYPES = [shapefile.POINT, shapefile.POINTM, shapefile.POINTZ, shapefile.MULTIPOINT, shapefile.MULTIPOINTM, shapefile.MULTIPOINTZ]
+LINE_TYPES = [shapefile.POLYLINE, shapefile.POLYLINEM, shapefile.POLYLINEZ]
+POLYGON_TYPES = [shapefile.POLYGON, shapefile.POLYGONM, shapefile.POLYGONZ]
+
+def shapeToWKB(shape):
+    """Convert a pyshp shape into a little endian WKB multi-geometry (since
+    geometry columns are always multi-geometries), without going through
+    WKT. Only the X and Y coordinates are kept. Returns None for null
+    shapes"""
+    if shape.shapeType == shapefile.NULL:
+        return None
+
+    if shape.shapeType in POINT_TYPES:
+        points = shape.points
+        buf = [_header(WKB_MULTIPOINT, len(points))]
+        for point in points:
+            buf.append(_header(WKB_POINT))
+            buf.append(struct.pack("<2d", point[0], point[1]))
+        return WKB("".join(buf))
+
+    if shape.shapeType in LINE_TYPES:
+        parts = _parts(shape)
+        buf = [_header(WKB_MULTILINESTRING, len(parts))]
+        for part in parts:
+            buf.append(_header(WKB_LINESTRING))
+            buf.append(_points(part))
+        return WKB("".join(buf))
+
+    if shape.shapeType in POLYGON_TYPES:
+        polygons = _polygons(_parts(shape))
+        buf = [_header(WKB_MULTIPOLYGON, len(polygons))]
+        for rings in polygons:
+            buf.append(_header(WKB_POLYGON, len(rings)))
+            for ring in rings:
+                buf.append(_points(ring))
+        return WKB("".join(buf))
+
+    raise ValueError("Unsupported shape type %d" % shape.shapeType)
+
+def _header(type, count=None):
+    """Return the byte order and type of a geometry (and the number of items
+    in it)"""
+    if count is None:
+        return struct.pack("<BI", 1, type)
+    return struct.pack("<BII", 1, type, count)
+
+def _points(points):
+    """Return the number of points, followed by the X and Y of each one"""
+    return struct.pack("<I%dd" % (len(points) * 2), len(points), *itertools.chain.from_iterable(point[:2] for point in points))
+
+def _parts(shape):
+    """Split the points of a shape into its parts"""
+    starts = list(shape.parts) + [len(shape.points)]
+    return [shape.points[start:stop] for start, stop in zip(starts, starts[1:])]
+
+def _polygons(rings):
+    """Group the rings of a polygon shape into polygons. In a shapefile, the
+    outer ring of a polygon is clockwise, and is followed by its holes, which
+    are counterclockwise"""
+    polygons = []
+    for ring in rings:
+        if not polygons or _isClockwise(ring):
+            polygons.append([ring])
+        else:
+            polygons[-1].append(ring)
+    return polygons
+
+def _isClockwise(ring):
+    area = 0.0
+    for (x1, y1), (x2, y2) in zip((point[:2] for point in ring), (point[:2] for point in ring[1:])):
+        area += x1 * y2 - x2 * y1
+    return area < 0
@@ -0,0 +1,111 @@
+import os
+import mmap
+import struct
+import shutil
+import zipfile
+import tempfile
+
+# the length of the fixed size part of a zip local file header
+LOCAL_HEADER_SIZE = 30
+
+class ShapefileArchive(object):
+    """
+    This opens the members of an uploaded zip file as file objects. Members
+    that are stored without compression (which is what most tools do for
+    shapefiles that are already big) are read straight out of a memory map of
+    the zip file. Compressed members are decompressed to a file once, and read
+    from there after that
+    """
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'r')
+        self._file = open(path, 'rb')
+        self._mmap = None
+
+    def isStored(self, name):
+        """Return True if the member `name` can be read without decompressing
+        it"""
+        info = self.zip.getinfo(name)
+        return info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1
+
+    def extract(self, name, path):
+        """Decompress the member `name` to `path`, unless it is already
+        there"""
+        if os.path.exists(path):
+            return
+        # write to a temporary file first, so a partially decompressed file is
+        # never left at `path`
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                member = self.zip.open(name)
+                shutil.copyfileobj(member, f, 1024 * 1024)
+                member.close()
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def open(self, name, extracted_path):
+        """Return a readable, seekable file object for the member `name`. If
+        the member is compressed, it is read from `extracted_path` (and
+        decompressed there first, if that hasn't been done yet)"""
+        if self.isStored(name):
+            if self._mmap is None:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            info = self.zip.getinfo(name)
+            return MappedMember(self._mmap, self._dataOffset(info), info.file_size)
+
+        self.extract(name, extracted_path)
+        return open(extracted_path, 'rb')
+
+    def read(self, name):
+        """Return the contents of the member `name`"""
+        return self.zip.read(name)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+        self.zip.close()
+
+    def _dataOffset(self, info):
+        """Return where the data of a member starts in the zip file. The local
+        header in front of it can have a different size extra field than the
+        one in the central directory, so it has to be read"""
+        self._file.seek(info.header_offset)
+        header = self._file.read(LOCAL_HEADER_SIZE)
+        if len(header) != LOCAL_HEADER_SIZE or header[:4] != "PK\x03\x04":
+            raise zipfile.BadZipfile("Bad local file header for %s" % info.filename)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        return info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+class MappedMember(object):
+    """A read only file object over `size` bytes of an mmap, starting at
+    `offset`"""
+    def __init__(self, mm, offset, size):
+        self.mmap = mm
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        n = max(0, min(n, self.size - self.pos))
+        start = self.offset + self.pos
+        self.pos += n
+        return self.mmap[start:start + n]
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self.pos = max(0, pos)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
@@ -6,6 +6,7 @@ from .api import views as api
 from .shapefiles import views as shapefile
 from .accounts import views as accounts
 from .querybuilder import views as querybuilder
+from .importable import views as importable
 
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
@@ -22,6 +23,10 @@ urlpatterns = patterns('',
     url(r'^shapefile/upload/?$', shapefile.upload, name='shapefile-upload'),
     url(r'^shapefile/preview/?$', shapefile.preview, name="shapefile-preview"),
 
+    # imports
+    url(r'^import/status/(\d+)/?$', importable.status, name='importable-status'),
+    url(r'^import/telemetry/(\d+)/?$', importable.telemetry, name='importable-telemetry'),
+
     # documents
     url(r'^doc/upload/?$', doc.upload, name='doc-upload'),
     url(r'^doc/?$', doc.all, name='doc-all'),
@@ -34,6 +39,9 @@ urlpatterns = patterns('',
 
     # schemas
     url(r'^schemas/tables/?$', schemas.tables, name="schemas-tables"),
+    url(r'^schemas/catalog/?$', schemas.catalogSchemas, name="schemas-catalog"),
+    url(r'^schemas/catalog/([^/]+)/tables/?$', schemas.catalogTables, name="schemas-catalog-tables"),
+    url(r'^schemas/catalog/([^/]+)/tables/([^/]+)/columns/?$', schemas.catalogColumns, name="schemas-catalog-columns"),
     url(r'^schemas/show/(.*)/(.*)/?$', schemas.show, name="schemas-show"),
     url(r'^schema/permissions/?$', schemas.permissions, name="schemas-permissions"),
     url(r'^schema/users/?$', schemas.users, name="schemas-users"),
@@ -1,19 +1,69 @@
 import re
+import sys
+import json
+import uuid
+import Queue
+import base64
+import hashlib
+import threading
 import sqlparse
+from django.core.cache import get_cache
+from django.db.models import Max, F, get_model
+from django.core.paginator import Paginator, Page, PageNotAnInteger, EmptyPage
 from django.contrib.gis.geos import GEOSGeometry
-from django.db import connection, transaction, DatabaseError, connections
-from datacommons.schemas.models import ColumnTypes, AUDIT_SCHEMA_NAME, TableOrView, Schema, View, Table, Column
+from django.db import connection, transaction, DatabaseError, IntegrityError, connections
+from datacommons.schemas.models import ColumnTypes, AUDIT_SCHEMA_NAME, TableOrView, Schema, View, Table, Column, TopologyGeneration, Version
+from datacommons.utils.inference import ColumnTypeInferrer, STRICTEST_FIRST, TIMESTAMP_TYPES
+from datacommons.utils.lru import LRUCache
 
-# get a list of reserved words
-cur = connection.cursor()
-cur.execute("""Select word from pg_get_keywords() WHERE catcode = 'R'""")
-RESERVED_WORDS = set()
-for word, in cur:
-    RESERVED_WORDS.add(word.lower())
+# the facts about the database server this process looked up (see serverInfo)
+_server_info = None
+
+def serverInfo():
+    """
+    Return a dict of the things about the database server that only change
+    when it is upgraded: the reserved words ("reserved_words"), and the cursor
+    type code (OID) of each type in ColumnTypes.TO_PG_TYPE ("type_codes").
+    They are looked up in one query the first time they are needed, and kept
+    in the "server" cache under the server version, so processes don't need
+    the database just to start up
+    """
+    global _server_info
+    if _server_info is None:
+        cursor = connection.cursor()
+        # the version is known as soon as there is a connection, so this
+        # doesn't need a query
+        settings = connection.settings_dict
+        key = "server:%s" % hashlib.sha1("%s:%s:%s:%s" % (
+            settings['HOST'],
+            settings['PORT'],
+            settings['NAME'],
+            connection.connection.server_version,
+        )).hexdigest()
+        cache = get_cache("server")
+        info = cache.get(key)
+        if info is None:
+            info = _queryServerInfo(cursor)
+            cache.set(key, info)
+        _server_info = info
+    return _server_info
+
+def _queryServerInfo(cursor):
+    type_names = sorted(ColumnTypes.TO_PG_TYPE.values())
+    cursor.execute("""
+        SELECT
+            ARRAY(SELECT lower(word) FROM pg_get_keywords() WHERE catcode = 'R'),
+            ARRAY[%s]
+    """ % ", ".join(["%s::regtype::oid::bigint"] * len(type_names)), type_names)
+    reserved_words, type_codes = cursor.fetchone()
+    return {
+        "reserved_words": set(reserved_words),
+        "type_codes": dict(zip(type_names, type_codes)),
+    }
 
 def isSaneName(value):
     """Return true if value is a valid identifier"""
-    if value.lower() in RESERVED_WORDS:
+    if value.lower() in serverInfo()['reserved_words']:
         return False
     return value == sanitize(value) and len(value) >= 1 and len(value) <= 63 and re.search("^[a-z]", value)
 
@@ -69,106 +119,156 @@ def inferColumnTypes(rows):
     determine the appropriate postgres datatype for that column. Return a list
     of ColumnTypes enums where the n-th item in the list corrsponds to the
     datatype of the n-th column in the table"""
-    transposed = zip(*rows)
-    return map(_inferColumnType, transposed)
-
-def _inferColumnType(data):
-    # try to deduce the column type
-    # this must be ordered from most strict type to least strict type
-    is_valid_as_type = [
-        ColumnTypes.GEOMETRY,
-        ColumnTypes.TIMESTAMP_WITH_ZONE,
-        ColumnTypes.TIMESTAMP,
-        ColumnTypes.INTEGER,
-        ColumnTypes.NUMERIC,
-        ColumnTypes.CHAR,
-    ]
-
-    # for each data item, for each type, check if that data item is an
-    # acceptable value for that type
-    for val in data:
-        is_valid_as_type = [type for type in is_valid_as_type if _isValidValueAsPGType(val, type)]
-
-    return is_valid_as_type[0]
-
-def _isValidValueAsPGType(value, type):
-    pg_type = ColumnTypes.toPGType(type)
-    cursor = connection.cursor()
+    inferrer = columnTypeInferrer()
+    for row in rows:
+        inferrer.add(row)
+    return inferrer.types()
+
+def columnTypeInferrer():
+    """Return a ColumnTypeInferrer that asks postgres about the values it
+    can't decide on itself"""
+    return ColumnTypeInferrer(_validTypesForValues)
+
+def _validTypesForValues(values, types):
+    """Return a bitmask of the ColumnTypes in the `types` bitmask that postgres
+    accepts every value in `values` as. There is one query per type (and one
+    for both kinds of timestamps)"""
+    values = list(values)
+    valid = 0
+    if types & TIMESTAMP_TYPES:
+        valid |= _validTimestampTypes(values) & types
+
+    for type in STRICTEST_FIRST:
+        if type & types and not type & TIMESTAMP_TYPES and _areValidValuesAsPGType(values, type):
+            valid |= type
+
+    return valid
+
+def _areValidValuesAsPGType(values, type):
+    """Return True if postgres accepts every value in `values` as `type`. This
+    is done with a single query"""
     if type == ColumnTypes.GEOMETRY:
-        try:
-            with transaction.atomic():
-                cursor.execute("""SELECT ST_GeomFromText(%s)""", (value,))
-        except DatabaseError as e:
-            return False
+        sql = """SELECT COUNT(ST_GeomFromText(v)) FROM unnest(%s::text[]) AS v"""
     else:
-        try:
-            with transaction.atomic():
-                cursor.execute("""SELECT %%s::%s""" % (pg_type), (value,))
-        except DatabaseError as e:
-            return False
-
-    # if we're checking for a timestamp with a timezone, we need to figure out
-    # if it *actually* has a timezone component, since postgres unfortunately
-    # assumes UTC when a timezone is not present
-    if type == ColumnTypes.TIMESTAMP_WITH_ZONE:
-        timestamp_pg_type = ColumnTypes.toPGType(ColumnTypes.TIMESTAMP)
-        # compare the value as a TIMESTAMP WITH TIME ZONE and a TIMEZONE. If they
-        # are equal, then this value does *not* have a useful timezone
-        # component
-        cursor.execute("""SELECT %%s::%s = %%s::%s""" % (pg_type, timestamp_pg_type), (value, value))
-        if cursor.fetchone()[0]:
-            return False
+        sql = """SELECT COUNT(v::%s) FROM unnest(%%s::text[]) AS v""" % ColumnTypes.toPGType(type)
 
+    cursor = connection.cursor()
+    try:
+        with transaction.atomic():
+            cursor.execute(sql, (values,))
+    except DatabaseError as e:
+        return False
     return True
 
-def getDatabaseTopology(owner=None):
+def _validTimestampTypes(values):
+    """Return a bitmask of the timestamp ColumnTypes every value in `values` is
+    valid as"""
+    # if we're checking for a timestamp with a timezone, we need to figure out
+    # if it *actually* has a timezone component, since postgres unfortunately
+    # assumes UTC when a timezone is not present. So compare the value as a
+    # TIMESTAMP WITH TIME ZONE and a TIMESTAMP. If they are equal, then the
+    # value does *not* have a useful timezone component
+    sql = """SELECT bool_or(v::%s = v::%s) FROM unnest(%%s::text[]) AS v""" % (
+        ColumnTypes.toPGType(ColumnTypes.TIMESTAMP_WITH_ZONE),
+        ColumnTypes.toPGType(ColumnTypes.TIMESTAMP),
+    )
+    cursor = connection.cursor()
+    try:
+        with transaction.atomic():
+            cursor.execute(sql, (values,))
+            any_without_zone = cursor.fetchone()[0]
+    except DatabaseError as e:
+        return 0
+
+    if any_without_zone:
+        return ColumnTypes.TIMESTAMP
+    return TIMESTAMP_TYPES
+
+def invalidateTopology():
+    """Throw out the cached topology. This must be called whenever a schema,
+    table, view or column is created, changed or dropped"""
+    if TopologyGeneration.objects.filter(pk=1).update(generation=F("generation") + 1):
+        return
+
+    # this is the first change, so the row has to be created
+    try:
+        with transaction.atomic():
+            TopologyGeneration.objects.create(pk=1, generation=1)
+    except IntegrityError:
+        # another transaction created it first
+        TopologyGeneration.objects.filter(pk=1).update(generation=F("generation") + 1)
+
+def topologyGeneration():
+    """Return the generation of the topology (see TopologyGeneration)"""
+    generations = list(TopologyGeneration.objects.filter(pk=1).values_list("generation", flat=True))
+    return generations[0] if generations else 0
+
+# the generation and rows of the topology this process last used
+_topology_rows = (None, None)
+
+def _fetchTopologyRows():
+    """Return the rows of the topology query. They are cached in this process,
+    and in the "topology" cache (which is shared by every process), under the
+    current generation, so a stale topology is never returned"""
+    global _topology_rows
+    generation = topologyGeneration()
+    if _topology_rows[0] == generation:
+        return _topology_rows[1]
+
+    cache = get_cache("topology")
+    key = "topology:%d" % generation
+    rows = cache.get(key)
+    if rows is None:
+        rows = _queryTopologyRows()
+        cache.set(key, rows)
+
+    _topology_rows = (generation, rows)
+    return rows
+
+def _queryTopologyRows():
+    """Return a row for every column of every table and view in the topology,
+    along with whether it is part of the primary key, and the SRID of geometry
+    columns. This reads the system catalogs directly, since the
+    information_schema views are slow when there are lots of relations"""
     sql = """
         SELECT
             nspname,
             t.name,
             t.is_view,
-            c.column_name,
-            CASE WHEN c.data_type = 'USER-DEFINED' THEN 'geometry' ELSE c.data_type END AS data_type,
-            pks.constraint_type,
-            CASE WHEN c.data_type = 'USER-DEFINED' AND not t.is_view THEN Find_SRID(nspname::varchar, t.name::varchar, c.column_name::varchar) ELSE NULL END AS srid
+            a.attname,
+            CASE WHEN tn.nspname != 'pg_catalog' THEN 'geometry' ELSE format_type(a.atttypid, NULL) END AS data_type,
+            pk.indkey IS NOT NULL AND a.attnum = ANY(pk.indkey) AS is_pk,
+            CASE WHEN NOT t.is_view THEN gc.srid ELSE NULL END AS srid
         FROM
             pg_namespace
         LEFT JOIN
-            -- information_schema.tables t ON t.table_schema = nspname
-        "table" AS t ON t.schema = nspname AND t.created_on IS NOT NULL
+            "table" AS t ON t.schema = nspname AND t.created_on IS NOT NULL
+        LEFT JOIN
+            pg_class c ON c.relnamespace = pg_namespace.oid AND c.relname = t.name
         LEFT JOIN
-            information_schema.columns c on c.table_schema = nspname AND t.name = c.table_name
-        LEFT JOIN (
-            SELECT
-                tc.table_schema,
-                tc.table_name,
-                column_name,
-                tc.constraint_type
-            FROM
-                information_schema.table_constraints as tc
-            INNER JOIN
-                information_schema.key_column_usage as kcu
-            ON
-                tc.constraint_name = kcu.constraint_name
-                AND
-                tc.table_schema = kcu.table_schema
-                AND
-                tc.table_name = kcu.table_name
-            WHERE
-                tc.constraint_type = 'PRIMARY KEY'
-        ) pks ON pks.table_schema = nspname AND pks.table_name = t.name AND pks.column_name = c.column_name
+            pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        LEFT JOIN
+            pg_type ty ON ty.oid = a.atttypid
+        LEFT JOIN
+            pg_namespace tn ON tn.oid = ty.typnamespace
+        LEFT JOIN
+            pg_index pk ON pk.indrelid = c.oid AND pk.indisprimary
+        LEFT JOIN
+            geometry_columns gc ON gc.f_table_schema = nspname AND gc.f_table_name = t.name AND gc.f_geometry_column = a.attname
         WHERE
             pg_namespace.nspowner != 10 AND
             nspname != 'geometries' AND
             nspname NOT IN(%s, %s)
         ORDER BY
-            nspname, t.name, c.ordinal_position
+            nspname, t.name, a.attnum
     """
     cursor = connection.cursor()
     cursor.execute(sql, (AUDIT_SCHEMA_NAME, "drupal"))
+    return cursor.fetchall()
 
+def getDatabaseTopology(owner=None):
     topology = []
-    for schema_name, table_name, is_view, column_name, data_type, constraint_type, srid in cursor.fetchall():
+    for schema_name, table_name, is_view, column_name, data_type, is_pk, srid in _fetchTopologyRows():
         # add the schema object
         if len(topology) == 0 or topology[-1].name != schema_name:
             topology.append(Schema(schema_name))
@@ -189,7 +289,7 @@ def getDatabaseTopology(owner=None):
         # this table has no columns, so move on
         if not column_name: continue
 
-        table.columns.append(Column(column_name, ColumnTypes.fromPGTypeName(data_type), constraint_type is not None, srid=srid))
+        table.columns.append(Column(column_name, ColumnTypes.fromPGTypeName(data_type), bool(is_pk), srid=srid))
 
     if owner:
         views = set((v.schema, v.name) for v in TableOrView.objects.filter(owner=owner))
@@ -208,16 +308,53 @@ def getPrimaryKeysForTable(schema, table):
     cols = getColumnsForTable(schema, table)
     return [col for col in cols if col.is_pk]
 
+# the rows of _queryColumnsForTable for the tables used recently in this
+# process, keyed by the generation of the topology, schema and table
+_columns_cache = LRUCache(128)
+
 def getColumnsForTable(schema, table):
     """Return a list of columns in schema.table"""
-    topology = getDatabaseTopology()
-    for s in topology:
-        if s.name == schema:
-            break
+    key = (topologyGeneration(), schema, table)
+    if key not in _columns_cache:
+        _columns_cache[key] = _queryColumnsForTable(schema, table)
+
+    # build new Column objects every time, since callers change them
+    return [
+        Column(column_name, ColumnTypes.fromPGTypeName(data_type), is_pk, srid=srid, geom_type=geom_type)
+        for column_name, data_type, is_pk, srid, geom_type in _columns_cache[key]
+    ]
 
-    for t in s:
-        if t.name == table:
-            return t.columns
+def _queryColumnsForTable(schema, table):
+    """Look up the columns of one table or view in the catalog"""
+    sql = """
+        SELECT
+            a.attname,
+            CASE WHEN tn.nspname != 'pg_catalog' THEN 'geometry' ELSE format_type(a.atttypid, NULL) END,
+            EXISTS(
+                SELECT 1 FROM pg_index i WHERE i.indrelid = c.oid AND i.indisprimary AND a.attnum = ANY(i.indkey)
+            ),
+            gc.srid,
+            gc.type
+        FROM
+            pg_class c
+        INNER JOIN
+            pg_namespace n ON n.oid = c.relnamespace
+        INNER JOIN
+            pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        INNER JOIN
+            pg_type ty ON ty.oid = a.atttypid
+        INNER JOIN
+            pg_namespace tn ON tn.oid = ty.typnamespace
+        LEFT JOIN
+            geometry_columns gc ON gc.f_table_schema = n.nspname AND gc.f_table_name = c.relname AND gc.f_geometry_column = a.attname
+        WHERE
+            n.nspname = %s AND c.relname = %s
+        ORDER BY
+            a.attnum
+    """
+    cursor = connection.cursor()
+    cursor.execute(sql, (schema, table))
+    return cursor.fetchall()
 
 def fetchRowsFor(schema, table, columns=None):
     """Return a 2-tuple of the rows in schema.table, and the cursor description"""
@@ -236,54 +373,177 @@ def fetchRowsFor(schema, table, columns=None):
     else:
         sql = '''SELECT %s FROM "%s"."%s" ''' % (column_str, schema, table)
 
-    return SQLHandle(sql)
+    # the rows can only be paged through by primary key if it is selected
+    keys = [pk.name for pk in pks]
+    if columns and not set(keys) <= set(sanitize(col) for col in columns):
+        keys = []
+
+    return SQLHandle(sql, keys=keys, table=(schema, table))
+
+# SQLHandle.count() only counts the rows exactly when there are about this
+# many or fewer. Otherwise it estimates
+EXACT_COUNT_LIMIT = 100000
+
+# the number of rows fetched at a time when iterating over a SQLHandle
+ITERSIZE = 2000
+
+# the size of the chunks SQLHandle.copyCSV() yields, and the most chunks that
+# can be waiting to be sent
+COPY_CHUNK_SIZE = 64 * 1024
+COPY_QUEUE_SIZE = 16
 
 class SQLHandle(object):
     """This class wraps up a SQL statement with its parameters and allows it to
-    be paginated over efficently, and iterated over"""
-    def __init__(self, sql, params=(), privileged=False):
+    be paginated over efficently, and iterated over. If the SQL is ordered by
+    a unique set of columns, they can be passed in as `keys`, so it can be
+    paginated with keysetPage(). If the SQL selects every row of a table,
+    `table` should be a 2-tuple of its schema and name, so it can be counted
+    quickly. Rows are only counted exactly if there are fewer than
+    `exact_count_limit` (None means always). Iterating over all the rows
+    fetches `itersize` of them from the database at a time"""
+    def __init__(self, sql, params=(), privileged=False, keys=(), table=None, exact_count_limit=EXACT_COUNT_LIMIT, itersize=ITERSIZE):
         self._sql = sql
         self._params = params
         self._count = None
         self._cursor = None
         self._cols = None
         self._user = "readonly" if not privileged else "default"
+        self._keys = list(keys)
+        self._table = table
+        self._exact_count_limit = exact_count_limit
+        self._itersize = itersize
+        # whether the result of count() is an estimate
+        self.count_is_estimate = False
 
-    def count(self):
-        """Returns a count of the number of rows returned by the SQL. This method helps make this class Django Paginator compatible""" 
+    @property
+    def has_keys(self):
+        """Return True if keysetPage() can be used"""
+        return len(self._keys) > 0
+
+    def count(self, exact=False):
+        """Returns a count of the number of rows returned by the SQL. This method helps make this class Django Paginator compatible.
+        When there are a lot of rows, this is an estimate (see count_is_estimate), unless `exact` is True""" 
+        if self._count == None or (exact and self.count_is_estimate):
+            self._count, self.count_is_estimate = self._countRows(exact)
+        return self._count
+
+    def quickCount(self):
+        """Return what count() would, if it can be found without counting the
+        rows (because the count is cached, or there are enough rows that it
+        is estimated), otherwise None"""
         if self._count == None:
-            # construct some SQL that will efficently return the number of rows
-            # returned by the SQL 
-            cursor = connections[self._user].cursor()
-            count_sql = "SELECT COUNT(*) FROM (" + self._sql + ") AS f"
-            cursor.execute(count_sql, self._params)
-            self._count = cursor.fetchall()[0][0]
+            counted = self._countRows(count=False)
+            if counted is None:
+                return None
+            self._count, self.count_is_estimate = counted
         return self._count
 
+    def _countRows(self, exact=False, count=True):
+        """Return the number of rows, and whether it is an estimate. The exact
+        counts of tables are cached until a new version of them is made. If
+        the rows would have to be counted and `count` is False, None is
+        returned instead"""
+        cache = get_cache("counts")
+        key = self._countCacheKey()
+        if key is not None:
+            count = cache.get(key)
+            if count is not None:
+                return count, False
+
+        if not exact and self._exact_count_limit is not None:
+            estimate = self._estimateCount()
+            if estimate > self._exact_count_limit:
+                return estimate, True
+
+        if not count:
+            return None
+
+        # construct some SQL that will efficently return the number of rows
+        # returned by the SQL 
+        cursor = connections[self._user].cursor()
+        count_sql = "SELECT COUNT(*) FROM (" + self._sql + ") AS f"
+        cursor.execute(count_sql, self._params)
+        count = cursor.fetchall()[0][0]
+        if key is not None:
+            cache.set(key, count)
+        return count, False
+
+    def _countCacheKey(self):
+        """Return the key the exact count of the table is cached under, which
+        includes the latest version of it, or None if it can't be cached. A
+        chunked import commits many times under the same version, so the
+        count isn't cached until that import is done"""
+        if self._table is None:
+            return None
+        schema, table = self._table
+        version_id = Version.objects.filter(table__schema=schema, table__name=table, table__is_view=False).aggregate(version_id=Max("pk"))['version_id']
+        if version_id is None:
+            return None
+        # this module is imported by the model's module, so the model can't be
+        # imported here
+        ImportableUpload = get_model("importable", "ImportableUpload")
+        if ImportableUpload.objects.filter(version_id=version_id).exclude(status__in=[ImportableUpload.DONE, ImportableUpload.ABANDONED]).exists():
+            return None
+        return "count:%s.%s:%d" % (schema, table, version_id)
+
+    def _estimateCount(self):
+        """Estimate the number of rows from the table statistics if this is a
+        plain table, or the query plan otherwise"""
+        cursor = connections[self._user].cursor()
+        if self._table is not None:
+            cursor.execute("""
+                SELECT c.reltuples FROM pg_class c INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = %s AND c.relname = %s AND c.relkind = 'r'
+            """, self._table)
+            row = cursor.fetchone()
+            # reltuples isn't set until the table is analyzed
+            if row is not None and row[0] > 0:
+                return int(row[0])
+
+        cursor.execute("EXPLAIN (FORMAT JSON) " + self._sql, self._params)
+        plan = cursor.fetchone()[0]
+        # older versions of psycopg2 don't parse json
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
     @property
     def cols(self):
         """Returns the the column info related to the SQL as a list of dicts
         with keys for the column name, type_label and type."""
         # we need to fetch the col info based on the SQL, since it hasn't been generated yet
         if self._cols == None:
-            # we haven't executed a query yet, so do that to get the cursor.description
             if self._cursor == None:
-                self._fetchRowsForQuery()
+                # we haven't executed a query yet, and only need the column info
+                self.describe()
+            else:
+                self._cols = self._colsFrom(self._cursor.description)
 
-            # build up the col info list
-            self._cols = [
-                Column(name=t.name, type=ColumnTypes.fromPGCursorTypeCode(t.type_code), is_pk=False)
-                for t in self._cursor.description
-            ]
+        return self._cols
 
+    def describe(self):
+        """Return the column info of the SQL, without fetching any rows. This
+        raises a DatabaseError if there is a problem with the SQL"""
+        cursor = connections[self._user].cursor()
+        cursor.execute("SELECT * FROM (" + self._sql + ") AS f LIMIT 0", self._params)
+        self._cols = self._colsFrom(cursor.description)
         return self._cols
 
+    def _colsFrom(self, description):
+        # build up the col info list
+        return [
+            Column(name=t.name, type=ColumnTypes.fromPGCursorTypeCode(t.type_code), is_pk=False)
+            for t in description
+        ]
+
     def __iter__(self):
         """Iterate over all the rows returned by the query"""
-        # if the cursor has already been set (like in the `self.cols` method)
-        # use that, otherwise execute the query
+        # if the cursor has already been set (like by slicing) use that,
+        # otherwise stream all the rows from the database
         if not self._cursor:
-            self._fetchRowsForQuery()
+            for row in self._streamRows():
+                yield row
+            return
 
         has_geom = any(c.type == ColumnTypes.GEOMETRY for c in self.cols)
 
@@ -297,6 +557,67 @@ class SQLHandle(object):
             for row in self._cursor:
                 yield self._castRow(row)
 
+    def _streamRows(self):
+        """Iterate over all the rows with a named (server side) cursor, so
+        only `itersize` rows are in memory at a time, no matter how many there
+        are. Named cursors only last as long as the transaction they are in,
+        so the rows are read in one"""
+        with transaction.atomic(using=self._user):
+            cursor = connections[self._user].connection.cursor(name="sqlhandle_%s" % uuid.uuid4().hex)
+            cursor.itersize = self._itersize
+            try:
+                cursor.execute(self._sql, self._params)
+                has_geom = None
+                for row in cursor:
+                    # the description of a named cursor isn't known until
+                    # the first rows are fetched
+                    if has_geom is None:
+                        if self._cols == None:
+                            self._cols = self._colsFrom(cursor.description)
+                        has_geom = any(c.type == ColumnTypes.GEOMETRY for c in self.cols)
+                    yield self._castRow(row) if has_geom else row
+            finally:
+                cursor.close()
+
+    def copyCSV(self):
+        """Return an iterator over chunks of the CSV of the rows (with a header
+        row), generated by PostgreSQL itself with COPY ... TO STDOUT.
+        Geometries are written as WKT. Raises ValueError if the columns can't
+        be selected by name, because some of them have the same name"""
+        sql = self._geometriesAs("ST_AsText(%s)")
+        connection = connections[self._user]
+        cursor = connection.cursor()
+        # COPY can't take parameters, so they are filled in here
+        sql = "COPY (" + cursor.mogrify(sql, self._params) + ") TO STDOUT WITH CSV HEADER"
+        return _copyChunks(connection.connection, sql)
+
+    def wkbRows(self):
+        """Return a SQLHandle for the same rows, except the geometries are WKB
+        strings instead of GEOSGeometry objects, and the outer rings of
+        polygons are clockwise, and their holes counterclockwise (like in a
+        shapefile). Raises ValueError if the columns can't be selected by
+        name, because some of them have the same name"""
+        handle = SQLHandle(self._geometriesAs("ST_AsBinary(ST_ForceRHR(%s))"), self._params, itersize=self._itersize)
+        handle._user = self._user
+        return handle
+
+    def _geometriesAs(self, geometry_sql):
+        """Return SQL that selects every column of the rows, with the
+        geometry columns wrapped in `geometry_sql`"""
+        names = [col.name for col in self.cols]
+        if len(set(names)) != len(names):
+            raise ValueError("The columns don't all have different names")
+
+        columns = []
+        for col in self.cols:
+            # the SQL has parameters filled in, so percent signs are escaped
+            name = '"%s"' % col.name.replace('"', '""').replace('%', '%%')
+            if col.type == ColumnTypes.GEOMETRY:
+                columns.append((geometry_sql % name) + " AS " + name)
+            else:
+                columns.append(name)
+        return "SELECT " + ",".join(columns) + " FROM (" + self._sql + ") AS f"
+
     def __getitem__(self, key):
         """Fetch part of the results of the query using slice notation for the
         offset and limit. Hopefully the query contains a well crafted order by
@@ -309,6 +630,80 @@ class SQLHandle(object):
         else:
             raise NotImplementedError("This class only supports __getitem__ via slicing")
 
+    def fetchPage(self, offset, limit, total=True):
+        """Return a 2-tuple of the `limit` rows starting at `offset`, and the
+        total number of rows (or None if there are no rows on the page, or
+        `total` is False). This gets both in one query, by tacking COUNT(*)
+        OVER () on to the end of every row. That has to read every row, so
+        it should only be used when there aren't many"""
+        if total:
+            sql = "SELECT *, COUNT(*) OVER () FROM (" + self._sql + ") AS f"
+        else:
+            sql = "SELECT * FROM (" + self._sql + ") AS f"
+        if self.has_keys:
+            sql += " ORDER BY " + ",".join('"%s"' % key for key in self._keys)
+        sql += " LIMIT %s OFFSET %s"
+        self._cursor = connections[self._user].cursor()
+        self._cursor.execute(sql, tuple(self._params) + (limit, offset))
+        if self._cols == None:
+            description = self._cursor.description
+            self._cols = self._colsFrom(description[:-1] if total else description)
+
+        has_geom = any(c.type == ColumnTypes.GEOMETRY for c in self.cols)
+        rows = []
+        count = None
+        for row in self._cursor:
+            if total:
+                count = row[-1]
+                row = row[:-1]
+            rows.append(self._castRow(row) if has_geom else row)
+        # the cursor is used up, so it can't be iterated over
+        self._cursor = None
+        return rows, count
+
+    def keysetPage(self, per_page, after=None, before=None):
+        """Return a KeysetPage of `per_page` rows following the row the
+        cursor `after` came from, or preceding the one `before` came from (or
+        the first page). Unlike slicing, this doesn't make the database skip
+        over all the rows on the pages before it, so every page is as fast as
+        the first. Raises ValueError if a cursor is invalid"""
+        if not self.has_keys:
+            raise ValueError("The SQL has no keys to paginate by")
+
+        keys = ",".join('"%s"' % key for key in self._keys)
+        if before is not None:
+            values = _decodeCursor(before, len(self._keys))
+            where = "WHERE (%s) < (%s)" % (keys, ",".join(["%s"] * len(values)))
+            order_by = ",".join('"%s" DESC' % key for key in self._keys)
+        elif after is not None:
+            values = _decodeCursor(after, len(self._keys))
+            where = "WHERE (%s) > (%s)" % (keys, ",".join(["%s"] * len(values)))
+            order_by = keys
+        else:
+            values = []
+            where = ""
+            order_by = keys
+
+        # fetch an extra row to find out if there is another page
+        sql = "SELECT * FROM (" + self._sql + ") AS f " + where + " ORDER BY " + order_by + " LIMIT %s"
+        self._cursor = connections[self._user].cursor()
+        self._cursor.execute(sql, tuple(self._params) + tuple(values) + (per_page + 1,))
+        rows = list(self)
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if before is not None:
+            rows.reverse()
+
+        names = [col.name for col in self.cols]
+        indexes = [names.index(key) for key in self._keys]
+        page = KeysetPage(rows)
+        if rows:
+            page.has_next = has_more if before is None else True
+            page.has_previous = has_more if before is not None else after is not None
+            page.next_cursor = _encodeCursor([rows[-1][i] for i in indexes])
+            page.previous_cursor = _encodeCursor([rows[0][i] for i in indexes])
+        return page
+
     def _castRow(self, row):
         """Convert a row of data to the appropriate types"""
         better_row = []
@@ -332,3 +727,130 @@ class SQLHandle(object):
             self._cursor.execute(sql, self._params)
 
 
+def _copyChunks(raw_connection, sql):
+    """Run the COPY ... TO STDOUT statement `sql` on a psycopg2 connection,
+    and yield what it outputs in chunks of about COPY_CHUNK_SIZE bytes.
+    psycopg2 only copies into a file, and doesn't return until it is done,
+    so the COPY runs in another thread, which hands the chunks over through a
+    queue. The queue is bounded, so the COPY waits when the chunks aren't
+    being sent fast enough"""
+    chunks = Queue.Queue(maxsize=COPY_QUEUE_SIZE)
+    done = object()
+    errors = []
+
+    class ChunkWriter(object):
+        def __init__(self):
+            self.buffer = []
+            self.size = 0
+
+        def write(self, data):
+            self.buffer.append(data)
+            self.size += len(data)
+            if self.size >= COPY_CHUNK_SIZE:
+                self.flush()
+
+        def flush(self):
+            if self.buffer:
+                chunks.put("".join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def copy():
+        try:
+            writer = ChunkWriter()
+            cursor = raw_connection.cursor()
+            cursor.copy_expert(sql, writer)
+            writer.flush()
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            chunks.put(done)
+
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+    finally:
+        if thread.is_alive():
+            # the response was closed before the end, so stop the COPY, and
+            # keep the queue empty until the thread notices
+            raw_connection.cancel()
+            while thread.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+
+class SQLPaginator(Paginator):
+    """A Paginator for a SQLHandle that doesn't count the rows separately.
+    If the count is cached, or there are enough rows that it is estimated
+    (see SQLHandle.quickCount), that is used. Otherwise there aren't many
+    rows, so the page and the total number of rows are fetched in one query
+    (see SQLHandle.fetchPage)"""
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        count = self.object_list.quickCount()
+        rows, total = self.object_list.fetchPage((number - 1) * self.per_page, self.per_page, total=count is None)
+        if rows:
+            self._count = total if count is None else count
+        elif number > 1:
+            # the page is past the end, so count the rows to find the last page
+            self._count = self.object_list.count(exact=True)
+            self._num_pages = None
+            raise EmptyPage('That page contains no results')
+        else:
+            self._count = 0
+        return Page(rows, number, self)
+
+
+class KeysetPage(object):
+    """A page of rows from SQLHandle.keysetPage(). The cursors are opaque
+    strings that can be passed back to keysetPage() to get the next or
+    previous page"""
+    def __init__(self, rows):
+        self.object_list = rows
+        self.has_next = False
+        self.has_previous = False
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+def _encodeCursor(values):
+    # the values are passed back to PG as strings, which it casts to the
+    # type of the key columns
+    values = [None if value is None else unicode(value) for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values)).rstrip("=")
+
+def _decodeCursor(cursor, n_keys):
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != n_keys:
+        raise ValueError("Invalid cursor")
+    return values
+
+
@@ -0,0 +1,269 @@
+import re
+import math
+import time
+import decimal
+import datetime
+from datacommons.schemas.models import ColumnTypes
+
+# every type a value could be valid as. ColumnTypes are powers of 2, so they
+# can be combined into bitmasks
+ALL_TYPES = (
+    ColumnTypes.INTEGER |
+    ColumnTypes.NUMERIC |
+    ColumnTypes.TIMESTAMP |
+    ColumnTypes.TIMESTAMP_WITH_ZONE |
+    ColumnTypes.CHAR |
+    ColumnTypes.GEOMETRY
+)
+TIMESTAMP_TYPES = ColumnTypes.TIMESTAMP | ColumnTypes.TIMESTAMP_WITH_ZONE
+
+# postgres only treats these characters as whitespace when parsing input
+_SPACE = r"[ \t\n\r\f\v]*"
+INTEGER_RE = re.compile(r"^%s[+-]?\d+%s$" % (_SPACE, _SPACE))
+NUMERIC_RE = re.compile(r"^%s(?:[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|nan)%s$" % (_SPACE, _SPACE), re.IGNORECASE)
+ISO_TIMESTAMP_RE = re.compile(r"""^%s
+    (?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})
+    (?:
+        (?:[ ]+|T)
+        (?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2})(?:\.\d+)?)?
+        %s
+        (?P<zone>Z|[+-]\d{2}(?::?\d{2})?)?
+    )?
+%s$""" % (_SPACE, _SPACE, _SPACE), re.IGNORECASE | re.VERBOSE)
+WKT_RE = re.compile(r"""^%s(?:SRID=-?\d+;)?%s(?:
+    POINT|LINESTRING|POLYGON|MULTIPOINT|MULTILINESTRING|MULTIPOLYGON|
+    GEOMETRYCOLLECTION|CIRCULARSTRING|COMPOUNDCURVE|CURVEPOLYGON|MULTICURVE|
+    MULTISURFACE|POLYHEDRALSURFACE|TRIANGLE|TIN
+)\b""" % (_SPACE, _SPACE), re.IGNORECASE | re.VERBOSE)
+SPECIAL_TIMESTAMPS = set("epoch infinity -infinity now today tomorrow yesterday".split())
+
+INTEGER_MIN = -2**31
+INTEGER_MAX = 2**31 - 1
+
+def classifyValue(value):
+    """
+    Figure out which ColumnTypes `value` can be cast to, following the same
+    rules postgres does. Returns a 2-tuple of bitmasks. The first is the types
+    the value is definitely valid as. The second is the types postgres might
+    or might not accept the value as (and so it has to be checked by postgres
+    itself). Any type that is in neither bitmask is definitely invalid.
+    """
+    if value is None:
+        # NULL can be cast to anything
+        return ALL_TYPES, 0
+
+    if isinstance(value, basestring):
+        return _classifyString(value)
+
+    valid = ColumnTypes.CHAR
+    if isinstance(value, bool):
+        # there is a cast from boolean to integer, but not to numeric
+        valid |= ColumnTypes.INTEGER
+    elif isinstance(value, (int, long)):
+        valid |= ColumnTypes.NUMERIC
+        if INTEGER_MIN <= value <= INTEGER_MAX:
+            valid |= ColumnTypes.INTEGER
+    elif isinstance(value, (float, decimal.Decimal)):
+        if isinstance(value, float) and math.isinf(value):
+            pass
+        elif value != value:
+            # NaN is a valid numeric, but can't be cast to an integer
+            valid |= ColumnTypes.NUMERIC
+        else:
+            valid |= ColumnTypes.NUMERIC
+            # casting a numeric to an integer rounds it
+            if INTEGER_MIN <= round(value) <= INTEGER_MAX:
+                valid |= ColumnTypes.INTEGER
+    elif isinstance(value, datetime.datetime):
+        valid |= ColumnTypes.TIMESTAMP
+        if _hasUsefulZone(value.utcoffset()):
+            valid |= ColumnTypes.TIMESTAMP_WITH_ZONE
+    elif isinstance(value, datetime.date):
+        valid |= ColumnTypes.TIMESTAMP
+
+    return valid, 0
+
+def _classifyString(value):
+    valid = ColumnTypes.CHAR
+    ambiguous = 0
+
+    if INTEGER_RE.match(value):
+        valid |= ColumnTypes.NUMERIC
+        if INTEGER_MIN <= int(value) <= INTEGER_MAX:
+            valid |= ColumnTypes.INTEGER
+    elif NUMERIC_RE.match(value):
+        valid |= ColumnTypes.NUMERIC
+
+    # postgres understands a *lot* of timestamp formats. Only the ISO 8601
+    # ones are handled here, anything else that might be a timestamp is left
+    # for postgres to decide
+    match = ISO_TIMESTAMP_RE.match(value)
+    if match and _isValidISOTimestamp(match):
+        valid |= ColumnTypes.TIMESTAMP
+        if _hasUsefulZone(_parseZone(match.group("zone"))):
+            valid |= ColumnTypes.TIMESTAMP_WITH_ZONE
+    elif value.strip().lower() in SPECIAL_TIMESTAMPS:
+        # these are never different with or without a time zone
+        valid |= ColumnTypes.TIMESTAMP
+    elif re.search(r"\d", value):
+        ambiguous |= TIMESTAMP_TYPES
+
+    if WKT_RE.match(value):
+        ambiguous |= ColumnTypes.GEOMETRY
+
+    return valid, ambiguous
+
+def _isValidISOTimestamp(match):
+    year, month, day = int(match.group("year")), int(match.group("month")), int(match.group("day"))
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        return False
+
+    if match.group("hour") is None:
+        return True
+
+    hour, minute, second = int(match.group("hour")), int(match.group("minute")), int(match.group("second") or 0)
+    if hour == 24:
+        # postgres allows 24:00:00, but nothing past it
+        return minute == 0 and second == 0
+    return hour < 24 and minute < 60 and second < 60
+
+def _parseZone(zone):
+    """Convert a zone like "Z", "-08" or "+05:30" to a timedelta"""
+    if zone is None:
+        return None
+    if zone.upper() == "Z":
+        return datetime.timedelta(0)
+    sign = -1 if zone[0] == "-" else 1
+    digits = zone[1:].replace(":", "")
+    return sign * datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0))
+
+def _hasUsefulZone(offset):
+    """Postgres assumes the session time zone when a timestamp doesn't have
+    one, so a timestamp only has a *useful* time zone component if it is
+    different from the session's. Django always sets the session time zone to
+    UTC (since USE_TZ is on)"""
+    return offset is not None and offset != datetime.timedelta(0)
+
+# the order types are picked in, from most strict type to least strict type
+STRICTEST_FIRST = [
+    ColumnTypes.GEOMETRY,
+    ColumnTypes.TIMESTAMP_WITH_ZONE,
+    ColumnTypes.TIMESTAMP,
+    ColumnTypes.INTEGER,
+    ColumnTypes.NUMERIC,
+    ColumnTypes.CHAR,
+]
+
+class ColumnTypeInferrer(object):
+    """
+    This infers the ColumnTypes of every column in a table, one chunk of rows
+    at a time, so it can be run over an entire file while it is being read.
+
+    For each column, a running bitmask of the types every value seen so far is
+    valid as is kept. Each chunk is classified a column at a time (with every
+    distinct value in the column classified once), and ANDed into the
+    bitmask. Once a column can only be text, its values aren't looked at
+    anymore.
+
+    The values postgres has to decide on are collected, and passed to
+    `resolve(values, types)` which must return a bitmask of the `types` that
+    every value is valid as. That happens at the end, or whenever too many
+    values pile up for a column. The total time spent inferring is kept in
+    `seconds`
+    """
+    CHUNK_SIZE = 1000
+    MAX_AMBIGUOUS = 5000
+
+    def __init__(self, resolve):
+        self.resolve = resolve
+        # the bitmask of valid types for each column
+        self.valid = []
+        # for each column, a dict of ambiguous types bitmask -> set of values
+        self.ambiguous = []
+        # the number of non null values in each column
+        self.seen = []
+        self.seconds = 0.0
+        self._chunk = []
+
+    def add(self, row):
+        self._chunk.append(row)
+        if len(self._chunk) >= self.CHUNK_SIZE:
+            self._flush()
+
+    def types(self):
+        """Return a list of ColumnTypes where the n-th item in the list
+        corresponds to the n-th column"""
+        self._flush()
+        start = time.time()
+        types = []
+        for i in range(len(self.valid)):
+            types.append(self._pick(i))
+        self.seconds += time.time() - start
+        return types
+
+    def _flush(self):
+        if not self._chunk:
+            return
+
+        start = time.time()
+        columns = zip(*self._chunk)
+        self._chunk = []
+        while len(self.valid) < len(columns):
+            self.valid.append(ALL_TYPES)
+            self.ambiguous.append({})
+            self.seen.append(0)
+
+        for i, values in enumerate(columns):
+            if self.valid[i] == ColumnTypes.CHAR:
+                continue
+
+            try:
+                distinct = set(values)
+            except TypeError:
+                # unhashable values, like lists
+                distinct = values
+
+            valid = self.valid[i]
+            ambiguous = self.ambiguous[i]
+            for value in distinct:
+                if value is None:
+                    continue
+                is_valid, is_ambiguous = classifyValue(value)
+                valid &= (is_valid | is_ambiguous)
+                if is_ambiguous:
+                    ambiguous.setdefault(is_ambiguous, set()).add(value)
+            self.valid[i] = valid
+            self.seen[i] += sum(1 for value in values if value is not None)
+
+            if sum(len(v) for v in ambiguous.values()) > self.MAX_AMBIGUOUS:
+                self._resolve(i, ALL_TYPES)
+
+        self.seconds += time.time() - start
+
+    def _resolve(self, i, types):
+        """Have `self.resolve` check the ambiguous values in column i for
+        `types`"""
+        pending = {}
+        for mask, values in self.ambiguous[i].items():
+            check = mask & types & self.valid[i]
+            if check:
+                self.valid[i] &= ~check | self.resolve(values, check)
+            remaining = mask & ~types
+            if remaining:
+                pending.setdefault(remaining, set()).update(values)
+        self.ambiguous[i] = pending
+
+    def _pick(self, i):
+        # a column of nothing but nulls could be anything, so make it text
+        if self.seen[i] == 0:
+            return ColumnTypes.CHAR
+
+        for type in STRICTEST_FIRST:
+            if not self.valid[i] & type:
+                continue
+            # both kinds of timestamps can be checked at the same time
+            self._resolve(i, TIMESTAMP_TYPES if type & TIMESTAMP_TYPES else type)
+            if self.valid[i] & type:
+                return type
@@ -0,0 +1,21 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A dict that only keeps the `size` most recently used items"""
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
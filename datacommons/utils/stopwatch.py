@@ -0,0 +1,52 @@
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+class Stopwatch(object):
+    """
+    This accumulates the time spent in named phases of some work, along with
+    the number of rows and bytes each phase handled. Phases can be nested, and
+    the time of a phase never includes the time of the phases inside it, so
+    the times of all the phases add up to the total time.
+
+    stopwatch = Stopwatch()
+    with stopwatch.time("insert") as counts:
+        counts['rows'] = cursor.execute(...)
+    """
+    def __init__(self):
+        # phase name -> dict of seconds, rows and bytes
+        self.phases = OrderedDict()
+        # the time spent in nested phases, for each phase that is running
+        self._nested = []
+
+    @contextmanager
+    def time(self, name, rows=None, bytes=None):
+        """Time the phase `name`. This yields a dict with the number of rows
+        and bytes handled by the phase, which can be updated inside the with
+        block"""
+        counts = {"rows": rows, "bytes": bytes}
+        self._nested.append(0.0)
+        start = time.time()
+        try:
+            yield counts
+        finally:
+            elapsed = time.time() - start
+            nested = self._nested.pop()
+            self._add(name, elapsed - nested, counts['rows'], counts['bytes'])
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def record(self, name, seconds, rows=None, bytes=None):
+        """Record time for a phase that was measured some other way. If this
+        is called inside another phase, that time is taken away from it"""
+        self._add(name, seconds, rows, bytes)
+        if self._nested:
+            self._nested[-1] += seconds
+
+    def _add(self, name, seconds, rows, bytes):
+        phase = self.phases.setdefault(name, {"seconds": 0.0, "rows": None, "bytes": None})
+        phase["seconds"] += seconds
+        if rows is not None:
+            phase["rows"] = (phase["rows"] or 0) + rows
+        if bytes is not None:
+            phase["bytes"] = (phase["bytes"] or 0) + bytes
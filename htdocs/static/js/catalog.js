@@ -0,0 +1,50 @@
+/*
+ * Fetches the schemas, tables and columns in the database from the catalog
+ * views, so pages only load the parts of the topology they need. Set
+ * Catalog.url to the URL of the schemas-catalog view before using it
+ */
+var Catalog = {
+    url: null,
+
+    tablesURL: function(schema_name){
+        return this.url + "/" + encodeURIComponent(schema_name) + "/tables";
+    },
+
+    columnsURL: function(schema_name, table_name){
+        return this.tablesURL(schema_name) + "/" + encodeURIComponent(table_name) + "/columns";
+    },
+
+    /*
+     * Call `each` with the results on every page of the list at `url`, as the
+     * pages come in, and then call `done`
+     */
+    fetchPages: function(url, params, each, done){
+        var page = 1;
+        var next = function(){
+            $.getJSON(url, $.extend({page: page}, params), function(data){
+                each(data.results);
+                if(data.has_next){
+                    page++;
+                    next();
+                } else if(done){
+                    done();
+                }
+            });
+        };
+        next();
+    },
+
+    schemas: function(each, done){
+        this.fetchPages(this.url, {}, each, done);
+    },
+
+    tables: function(schema_name, params, each, done){
+        this.fetchPages(this.tablesURL(schema_name), params, each, done);
+    },
+
+    columns: function(schema_name, table_name, callback){
+        $.getJSON(this.columnsURL(schema_name, table_name), function(data){
+            callback(data.columns);
+        });
+    }
+};
@@ -2,12 +2,16 @@
 function Schema(name){
     this.name = name
     this.tables = []
+    // whether the tables have been fetched from the catalog
+    this.loaded = false;
 }
 
 function Table(name, schema){
     this.schema = schema;
     this.name = name;
     this.columns = [];
+    // whether the columns have been fetched from the catalog
+    this.loaded = false;
 }
 
 Table.prototype.fullName = function(){
@@ -20,33 +24,6 @@ function Column(name, is_pk, table){
     this.is_pk = is_pk;
 }
 
-/*
- * Take in an object where the key is a schema name, and the value is an object
- * of tables, where the key is a table name, and the value is a list of
- * columns, where each item in the list is an object with a name and pk
- * attribute. Parse that into a list of Schema, Table and Column model objects
- */
-function parseSchemata(schemata){
-    var schemas = [];
-    for(var i = 0; i < schemata.length; i++){
-        var s = schemata[i];
-        var schema = new Schema(s.name);
-        var tables = s.tables.concat(s.views)
-        for(var j = 0; j < tables.length; j++){
-            var t = tables[j];
-            var table = new Table(t.name, schema);
-            var cols = t.columns
-            for(var k = 0; k < cols.length; k++){
-                var col = cols[k];
-                table.columns.push(new Column(col.name, col.is_pk, table));
-            }
-            schema.tables.push(table);
-        }
-        schemas.push(schema);
-    }
-    return schemas;
-}
-
 /*
  * Allows objects to register callbacks for events, and lets objects broadcast
  * events to all registered listeners.
@@ -809,34 +786,31 @@ TableView.prototype.bindEvents = function(){
     });
 }
 
-function SchemataView(schemas, container){
+function SchemataView(container){
     this.container = container;
-    this.schemas = schemas;
+    // the Schema objects, which get their tables when they are first opened
+    this.schemas = [];
 }
 
 SchemataView.prototype.render = function(){
-    var html = ['<ul>'];
-    for(var i = 0; i < this.schemas.length; i++){
-        var schema = this.schemas[i];
-        html.push(
-            "<li class='schema-info'>"
-                + "<span class='schema-name'>"
-                    + "<i class='icon-folder-close'></i> " + schema.name 
-                + "</span>"
-                + "<ul class='table-list'>");
-        var tables = schema.tables;
-        for(var j = 0; j < tables.length; j++){
+    this.container.find('.schemata-list').html("<ul></ul>");
+    var list = this.container.find('.schemata-list > ul');
+    var that = this;
+    Catalog.schemas(function(schemas){
+        var html = [];
+        for(var i = 0; i < schemas.length; i++){
+            that.schemas.push(new Schema(schemas[i].name));
             html.push(
-                "<li>"
-                    + "<i class='icon-list-alt'></i> "
-                    + "<span class='table-name'>" + tables[j].name + "</span>"
-                + "</li>")
+                "<li class='schema-info'>"
+                    + "<span class='schema-name'>"
+                        + "<i class='icon-folder-close'></i> " + schemas[i].name 
+                    + "</span>"
+                    + "<ul class='table-list'></ul>"
+                + "</li>");
         }
-        html.push("</ul></li>");
-    }
-
-    this.container.find('.schemata-list').html(html.join(""))
-    this.collapseAllTableLists();
+        list.append(html.join(""));
+        that.collapseAllTableLists();
+    });
     this.bindEvents();
 }
 
@@ -844,6 +818,41 @@ SchemataView.prototype.collapseAllTableLists = function(){
     this.container.find(".table-list").hide();
 }
 
+/*
+ * Fetch the tables in a schema, and add them to the table list under it. Only
+ * the views owned by the user are included
+ */
+SchemataView.prototype.loadTables = function(schema, table_list){
+    schema.loaded = true;
+    Catalog.tables(schema.name, {views: "own"}, function(tables){
+        var html = [];
+        for(var i = 0; i < tables.length; i++){
+            schema.tables.push(new Table(tables[i].name, schema));
+            html.push(
+                "<li>"
+                    + "<i class='icon-list-alt'></i> "
+                    + "<span class='table-name'>" + tables[i].name + "</span>"
+                + "</li>")
+        }
+        table_list.append(html.join(""));
+    });
+}
+
+/*
+ * Fetch the columns of a table (unless they already were), and then call
+ * `callback`
+ */
+SchemataView.prototype.loadColumns = function(table, callback){
+    if(table.loaded) return callback();
+    Catalog.columns(table.schema.name, table.name, function(columns){
+        table.loaded = true;
+        for(var i = 0; i < columns.length; i++){
+            table.columns.push(new Column(columns[i].name, columns[i].is_pk, table));
+        }
+        callback();
+    });
+}
+
 SchemataView.prototype.tableObjectFromDOM = function(element){
     var table_name = $.trim($(element).text());
     var schema_name = $.trim($(element).closest('.schema-info').find('.schema-name').text());
@@ -851,14 +860,18 @@ SchemataView.prototype.tableObjectFromDOM = function(element){
     return table;
 }
 
-SchemataView.prototype.findTableObject = function(schema_name, table_name){
-    // find the schema object
+SchemataView.prototype.findSchemaObject = function(schema_name){
     for(var i = 0; i < this.schemas.length; i++){
         var schema = this.schemas[i];
-        if(schema.name == schema_name) break;
+        if(schema.name == schema_name) return schema;
     }
+    return null;
+}
+
+SchemataView.prototype.findTableObject = function(schema_name, table_name){
+    var schema = this.findSchemaObject(schema_name);
+    if(!schema) return null;
 
-    // now find the table object
     for(var i = 0; i < schema.tables.length; i++){
         var table = schema.tables[i];
         if(table.name == table_name) return table;
@@ -868,11 +881,17 @@ SchemataView.prototype.findTableObject = function(schema_name, table_name){
 }
 
 SchemataView.prototype.bindEvents = function(){
+    var that = this;
     // when the schema name is clicked, slide up or down the list of tables,
-    // and change the folder icon to either open or closed
-    this.container.find(".schema-name").on('click', function(){
+    // and change the folder icon to either open or closed. The tables are
+    // loaded the first time
+    this.container.on('click', '.schema-name', function(){
         var table_list = $(this).closest("li").find('.table-list');
         var icon = $(this).find("i");
+        var schema = that.findSchemaObject($.trim($(this).text()));
+        if(schema && !schema.loaded){
+            that.loadTables(schema, table_list);
+        }
         if(table_list.is(":visible")){
             table_list.slideUp();
             icon.removeClass("icon-folder-open").addClass("icon-folder-close");
@@ -882,14 +901,16 @@ SchemataView.prototype.bindEvents = function(){
         }
     });
 
-    // notify the event listeners
-    var that = this;
+    // notify the event listeners, once the columns of the table are loaded
     this.container.on('click', '.table-name', function(){
         var table = that.tableObjectFromDOM($(this));
-        var event = {
-            table: table,
-        }
-        EventRegistry.broadcast(that, "click", event);
+        if(!table) return;
+        that.loadColumns(table, function(){
+            var event = {
+                table: table,
+            }
+            EventRegistry.broadcast(that, "click", event);
+        });
     });
 }
 